@@ -2,21 +2,28 @@
 Custom ComfyUI Nodes
 """
 
+import logging
+from .nodes import metrics
 from .nodes.load_image_folder import LoadImageFolder
 from .nodes.make_batch_from_single_image import MakeBatchFromSingleImage
-from .nodes.region_conditioning_nodes import RegionConditionSpecPct, RegionConditionSpecPx, RegionConditionMerge
+from .nodes.region_conditioning_nodes import RegionConditionSpecPct, RegionConditionSpecPx, RegionConditionSpecKeyframes, RegionConditionMerge
 from .nodes.attention_couple import AttentionCouple
 from .nodes.combine_video_clips import CombineVideoClips
 from .nodes.seamless_join_video_clips import WanVideoVaceSeamlessJoin
 import os
 import nodes
 
+# Parent of every node module's logger, its level comes from CUSTOMNODES_LOG_LEVEL
+logger = logging.getLogger(__name__)
+metrics.configure_logging(logger)
+
 # Combine all node mappings
 NODE_CLASS_MAPPINGS = {
     "LoadImageFolder": LoadImageFolder,
     "MakeBatchFromSingleImage": MakeBatchFromSingleImage,
     "RegionConditionSpecPct": RegionConditionSpecPct,
     "RegionConditionSpecPx": RegionConditionSpecPx,
+    "RegionConditionSpecKeyframes": RegionConditionSpecKeyframes,
     "RegionConditionMerge": RegionConditionMerge,
     "AttentionCouple": AttentionCouple,
     "CombineVideoClips": CombineVideoClips,
@@ -28,6 +35,7 @@ NODE_DISPLAY_NAME_MAPPINGS = {
     "MakeBatchFromSingleImage": "Make Batch from Single Image (Custom)",
     "RegionConditionSpecPct": "Region Condition Spec (Percentage)",
     "RegionConditionSpecPx": "Region Condition Spec (Pixels)",
+    "RegionConditionSpecKeyframes": "Region Condition Spec (Keyframes)",
     "RegionConditionMerge": "Region Condition Merge",
     "AttentionCouple": "Attention Couple",
     "CombineVideoClips": "Combine Video Clips",
@@ -0,0 +1,114 @@
+"""
+Compare the Pillow and OpenCV decode backends of nodes.image_utils.
+
+    python benchmarks/bench_image_decode.py --size 1024 --count 32
+    python benchmarks/bench_image_decode.py --check
+
+The large PNG case catches a fast path that decodes with Pillow before OpenCV: the OpenCV
+eligibility probe must stay a header read, and --check fails when it takes more than a tenth
+of a Pillow decode or the OpenCV backend is slower than Pillow.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import comfy_stubs
+comfy_stubs.install()
+
+import numpy as np
+from PIL import Image
+from nodes import image_utils
+
+def make_images(directory, fmt, size, count):
+    rng = np.random.default_rng(0)
+    paths = []
+    for index in range(count):
+        # Smooth gradients plus noise, so JPEG/PNG sizes are realistic
+        y, x = np.mgrid[0:size, 0:size]
+        base = np.stack([x * 255 // size, y * 255 // size, (x + y) * 127 // size], axis=-1)
+        noise = rng.integers(0, 32, size=(size, size, 3))
+        pixels = np.clip(base + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(directory, f"frame_{index:04d}.{fmt.lower()}")
+        Image.fromarray(pixels).save(path, fmt)
+        paths.append(path)
+    return paths
+
+def time_probe(paths, repeat):
+    """Time of the OpenCV eligibility check alone, on freshly opened images"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            with Image.open(path) as img:
+                image_utils.can_decode_with_opencv(img)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def time_backend(paths, backend, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for path in paths:
+            image_utils.load_image_frames(path, backend)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--count", type=int, default=16)
+    parser.add_argument("--large-size", type=int, default=2048, help="Size of the large PNG case")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--check", action="store_true", help="Exit with an error when the OpenCV path regresses")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    cases = [("PNG", args.size), ("JPEG", args.size), ("PNG", args.large_size)]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for fmt, size in cases:
+            case_directory = os.path.join(directory, f"{fmt}_{size}")
+            os.makedirs(case_directory)
+            count = args.count if size == args.size else max(1, args.count // 4)
+            paths = make_images(case_directory, fmt, size, count)
+            timings = {backend: time_backend(paths, backend, args.repeat) for backend in image_utils.IMAGE_DECODE_BACKENDS}
+            probe = time_probe(paths, args.repeat)
+            reference, _ = image_utils.load_image_frames(paths[0], "pillow")
+            candidate, _ = image_utils.load_image_frames(paths[0], "opencv")
+            results.append({
+                "format": fmt,
+                "size": size,
+                "count": count,
+                "seconds": timings,
+                "probe_seconds": probe,
+                "images_per_second": {k: count / v for k, v in timings.items()},
+                "speedup": timings["pillow"] / timings["opencv"],
+                "probe_share": probe / timings["pillow"],
+                "max_abs_diff": float((reference - candidate).abs().max()),
+            })
+
+    failures = []
+    for r in results:
+        print(f"{r['format']:>5} {r['size']}px x{r['count']}: "
+              f"pillow {r['images_per_second']['pillow']:.1f} img/s, "
+              f"opencv {r['images_per_second']['opencv']:.1f} img/s, "
+              f"speedup {r['speedup']:.2f}x, probe {r['probe_share']:.1%} of a pillow decode, "
+              f"max diff {r['max_abs_diff']:.4f}")
+        if r["probe_share"] > 0.1:
+            failures.append(f"{r['format']} {r['size']}px: the OpenCV probe decodes the image")
+        if r["speedup"] < 1.0:
+            failures.append(f"{r['format']} {r['size']}px: opencv is slower than pillow")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.check and failures:
+        print("\n".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""
+Throughput, peak RSS and allocation benchmarks for the image and video loader nodes.
+
+    python benchmarks/bench_io_nodes.py --width 640 --height 360 --frames 48 --json results.json
+    python benchmarks/bench_io_nodes.py --baseline old.json --json new.json
+
+Fixtures (MJPG clips written with cv2.VideoWriter and image folders with opaque, alpha,
+animated and mixed-size files) are generated into a temporary directory. Every case runs in
+its own subprocess so peak RSS belongs to that case alone. Allocation figures come from
+tracemalloc, which sees Python and numpy allocations but not torch's CPU allocator.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import comfy_stubs
+comfy_stubs.install()
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+import cv2
+import numpy as np
+from PIL import Image
+
+VIDEO_FOURCC = "MJPG"
+
+def synthetic_frame(index, width, height, channels=3, rng=None):
+    """Moving gradient plus noise, so encoders produce realistic frame sizes"""
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([(x + index * 4) * 255 // max(1, width), y * 255 // max(1, height),
+                     (x + y + index * 8) * 127 // max(1, width + height)], axis=-1) % 256
+    if rng is not None:
+        base = base + rng.integers(0, 24, size=base.shape)
+    frame = np.clip(base, 0, 255).astype(np.uint8)
+    if channels == 4:
+        # Alpha disc in the centre
+        alpha = (((x - width / 2) ** 2 + (y - height / 2) ** 2) < (min(width, height) / 3) ** 2) * 255
+        frame = np.concatenate([frame, alpha[..., None].astype(np.uint8)], axis=-1)
+    return frame
+
+def write_video(path, frame_count, width, height, fps=24):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*VIDEO_FOURCC), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"cv2.VideoWriter can't write {VIDEO_FOURCC} to {path}")
+    rng = np.random.default_rng(frame_count)
+    for index in range(frame_count):
+        writer.write(synthetic_frame(index, width, height, rng=rng))
+    writer.release()
+    return path
+
+def write_image_folder(directory, kind, count, width, height):
+    """kind is opaque, alpha, animated or mixed (varied sizes, half of them with alpha)"""
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(count)
+    for index in range(count):
+        if kind == "opaque":
+            fmt = "PNG" if index % 2 else "JPEG"
+            Image.fromarray(synthetic_frame(index, width, height, rng=rng)).save(
+                os.path.join(directory, f"{index:04d}.{'png' if fmt == 'PNG' else 'jpg'}"), fmt)
+        elif kind == "alpha":
+            Image.fromarray(synthetic_frame(index, width, height, 4, rng)).save(os.path.join(directory, f"{index:04d}.png"))
+        elif kind == "animated":
+            frames = [Image.fromarray(synthetic_frame(index * 8 + f, width, height, rng=rng)).convert("P") for f in range(8)]
+            frames[0].save(os.path.join(directory, f"{index:04d}.gif"), save_all=True, append_images=frames[1:], duration=40)
+        elif kind == "mixed":
+            scale = 1.0 if index == 0 else (0.5, 0.75, 1.25)[index % 3]
+            w, h = max(1, int(width * scale)), max(1, int(height * scale))
+            channels = 4 if index % 2 else 3
+            Image.fromarray(synthetic_frame(index, w, h, channels, rng)).save(os.path.join(directory, f"{index:04d}.png"))
+        else:
+            raise ValueError(f"Unknown folder kind: {kind}")
+    return directory
+
+def make_fixtures(directory, args):
+    fixtures = {"videos": {}, "folders": {}, "single_image": None, "packs": os.path.join(directory, "packs")}
+    for name in ("first", "joined", "last"):
+        fixtures["videos"][name] = write_video(os.path.join(directory, f"{name}.avi"), args.frames, args.width, args.height)
+    for kind in ("opaque", "alpha", "animated", "mixed"):
+        count = max(1, args.images // 4) if kind == "animated" else args.images
+        fixtures["folders"][kind] = write_image_folder(os.path.join(directory, kind), kind, count, args.width, args.height)
+    fixtures["single_image"] = os.path.join(directory, "single.png")
+    Image.fromarray(synthetic_frame(0, args.width, args.height, 4)).save(fixtures["single_image"])
+    return fixtures
+
+# Cases set up a node and return run(), which performs one execution and returns the node output
+
+def case_load_video_frames(fixtures, args):
+    from nodes.combine_video_clips import CombineVideoClips
+    node = CombineVideoClips()
+    return lambda: node.load_video_frames(fixtures["videos"]["first"], args.frames)
+
+def case_frames_to_tensor(fixtures, args):
+    from nodes.combine_video_clips import CombineVideoClips
+    node = CombineVideoClips()
+    frames = node.load_video_frames(fixtures["videos"]["first"], args.frames)
+    return lambda: node.frames_to_tensor(frames)
+
+def case_combine_videos(fixtures, args):
+    from nodes.combine_video_clips import CombineVideoClips
+    node = CombineVideoClips()
+    videos = fixtures["videos"]
+    return lambda: node.combine_videos(args.frames, 0, min(10, args.frames), first_video_path=videos["first"],
+                                       first_joined_video_path=videos["joined"], last_video_path=videos["last"])
+
+def case_process_videos(fixtures, args):
+    from nodes.seamless_join_video_clips import WanVideoVaceSeamlessJoin
+    node = WanVideoVaceSeamlessJoin()
+    videos = fixtures["videos"]
+    mask = min(4, args.frames // 4)
+    return lambda: node.process_videos(mask, mask, args.frames, first_video_path=videos["first"],
+                                       second_video_path=videos["last"])
+
+def load_image_folder_case(kind, use_pack=False, decode_backend="pillow"):
+    def case(fixtures, args):
+        os.environ["CUSTOMNODES_PACK_DIR"] = fixtures["packs"]
+        from nodes.load_image_folder import LoadImageFolder
+        node = LoadImageFolder()
+        folder = fixtures["folders"][kind]
+        return lambda: node.load_images_from_folder(folder, use_pack=use_pack, decode_backend=decode_backend)
+    return case
+
+def make_batch_case(materialize):
+    def case(fixtures, args):
+        import folder_paths
+        from nodes.make_batch_from_single_image import MakeBatchFromSingleImage
+        input_dir = folder_paths.get_input_directory()
+        os.makedirs(input_dir, exist_ok=True)
+        name = f"bench_make_batch_{os.getpid()}.png"
+        shutil.copyfile(fixtures["single_image"], os.path.join(input_dir, name))
+        atexit.register(os.remove, os.path.join(input_dir, name))
+        node = MakeBatchFromSingleImage()
+        return lambda: node.make_batch_from_single_image(args.batch, name, materialize=materialize)
+    return case
+
+CASES = {
+    "load_video_frames": case_load_video_frames,
+    "frames_to_tensor": case_frames_to_tensor,
+    "combine_videos": case_combine_videos,
+    "process_videos": case_process_videos,
+    "load_image_folder[opaque]": load_image_folder_case("opaque"),
+    "load_image_folder[opaque,opencv]": load_image_folder_case("opaque", decode_backend="opencv"),
+    "load_image_folder[alpha]": load_image_folder_case("alpha"),
+    "load_image_folder[animated]": load_image_folder_case("animated"),
+    "load_image_folder[mixed]": load_image_folder_case("mixed"),
+    "load_image_folder[opaque,pack]": load_image_folder_case("opaque", use_pack=True),
+    "make_batch_from_single_image[materialize]": make_batch_case(True),
+    "make_batch_from_single_image[view]": make_batch_case(False),
+}
+
+def output_size(result):
+    """(frames, bytes) of a node output, a tuple of tensors or a list of numpy frames"""
+    if isinstance(result, tuple):
+        result = result[0]
+    if isinstance(result, list):
+        return len(result), sum(frame.nbytes for frame in result)
+    return result.shape[0], result.numel() * result.element_size()
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # kilobytes on Linux
+
+def run_case(name, fixtures, args):
+    run = CASES[name](fixtures, args)
+    result = run() # warm-up, also fills the pack for the pack case
+    frames, output_bytes = output_size(result)
+    del result
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - start)
+        del result
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = run()
+    after = tracemalloc.take_snapshot()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    del result
+
+    best = min(timings)
+    return {
+        "case": name,
+        "seconds": {"best": best, "mean": sum(timings) / len(timings), "all": timings},
+        "frames": frames,
+        "output_bytes": output_bytes,
+        "frames_per_second": frames / best if best > 0 else None,
+        "megabytes_per_second": output_bytes / (1024 * 1024) / best if best > 0 else None,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "traced_peak_bytes": traced_peak,
+        "allocated_blocks": sum(stat.count_diff for stat in diff if stat.count_diff > 0),
+    }
+
+def run_isolated(name, fixtures_path, args):
+    command = [sys.executable, os.path.abspath(__file__), "--run-case", name, "--fixtures", fixtures_path,
+               "--frames", str(args.frames), "--batch", str(args.batch), "--repeat", str(args.repeat)]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {"case": name, "error": completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "failed"}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+def environment():
+    import torch
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=comfy_stubs.REPO_ROOT,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "opencv": cv2.__version__,
+        "cpu_count": os.cpu_count(),
+    }
+
+def print_results(results, baseline=None):
+    baseline = {r["case"]: r for r in (baseline or {}).get("results", []) if "error" not in r}
+    for r in results:
+        if "error" in r:
+            print(f"{r['case']:<44} error: {r['error']}")
+            continue
+        line = (f"{r['case']:<44} {r['seconds']['best'] * 1000:>9.1f} ms {r['frames_per_second']:>9.1f} frames/s "
+                f"{r['megabytes_per_second']:>8.1f} MB/s")
+        if r["peak_rss_bytes"] is not None:
+            line += f" rss {r['peak_rss_bytes'] / (1024 * 1024):>7.1f} MB"
+        line += f" traced {r['traced_peak_bytes'] / (1024 * 1024):>7.1f} MB blocks {r['allocated_blocks']:>7}"
+        if r["case"] in baseline:
+            line += f" ({baseline[r['case']]['seconds']['best'] / r['seconds']['best']:.2f}x vs baseline)"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--frames", type=int, default=48, help="Frames per generated clip and frame_load_cap")
+    parser.add_argument("--images", type=int, default=16, help="Images per generated folder")
+    parser.add_argument("--batch", type=int, default=16, help="batch_count of MakeBatchFromSingleImage")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", nargs="*", choices=sorted(CASES), help="Run only these cases")
+    parser.add_argument("--no-isolate", action="store_true", help="Run every case in this process, peak RSS then accumulates")
+    parser.add_argument("--baseline", help="Earlier --json output to compare against")
+    parser.add_argument("--json", help="Write results to this file")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    parser.add_argument("--fixtures", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        # Child process of an isolated run
+        with open(os.path.join(args.fixtures, "fixtures.json")) as f:
+            fixtures = json.load(f)
+        print(json.dumps(run_case(args.run_case, fixtures, args)))
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = make_fixtures(directory, args)
+        with open(os.path.join(directory, "fixtures.json"), "w") as f:
+            json.dump(fixtures, f)
+
+        results = []
+        for name in args.cases or CASES:
+            if args.no_isolate:
+                results.append(run_case(name, fixtures, args))
+            else:
+                results.append(run_isolated(name, directory, args))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.json:
+        report = {
+            "benchmark": "io_nodes",
+            "environment": environment(),
+            "parameters": {k: getattr(args, k) for k in ("width", "height", "frames", "images", "batch", "repeat")},
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
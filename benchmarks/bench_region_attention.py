@@ -0,0 +1,351 @@
+"""
+CPU microbenchmarks for RegionConditionMerge, attention mask downsampling and the AttentionCouple patch.
+
+    python benchmarks/bench_region_attention.py --regions 2 4 8 --resolutions 512 768 --batches 1 2
+    python benchmarks/bench_region_attention.py --modes standard sparse --chunk-sizes 0 2 --json results.json
+
+The patch runs on a toy SD1-shaped UNet whose attn2 modules only have to_k/to_v linears, so
+AttentionCouple goes through its real setup. Every patch and mask result is checked against a copy of
+the original implementation, fed the full-resolution masks the original RegionConditionMerge made. Peak memory is the high-water mark of tensor allocations made during a
+call, replayed from torch.profiler memory events.
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import comfy_stubs
+comfy_stubs.install()
+
+import torch
+import torch.nn.functional as F
+from comfy.ldm.modules.attention import optimized_attention
+from nodes import attention_couple, region_conditioning_nodes
+from nodes.attention_couple import AttentionCouple, get_masks_from_q
+from nodes.region_conditioning_nodes import RegionConditionMerge
+
+CONTEXT_TOKENS = 77
+CONTEXT_DIM = 768
+HEADS = 8
+
+# (patch key, down sample rate, channels) of one attn2 block per SD1 UNet level
+BENCH_BLOCKS = [(("input", 1), 1, 320), (("input", 4), 2, 640), (("input", 7), 4, 1280), (("middle", 0), 8, 1280)]
+INPUT_CHANNELS = [None, 320, 320, None, 640, 640, None, 1280, 1280, None, None, None]
+OUTPUT_CHANNELS = [None, None, None, 1280, 1280, 1280, 640, 640, 640, 320, 320, 320]
+
+class ToyCrossAttention(torch.nn.Module):
+    """The parts of a CrossAttention module the patch uses"""
+    def __init__(self, channels, heads=HEADS, context_dim=CONTEXT_DIM):
+        super().__init__()
+        self.heads = heads
+        self.dim_head = channels // heads
+        self.to_k = torch.nn.Linear(context_dim, channels, bias=False)
+        self.to_v = torch.nn.Linear(context_dim, channels, bias=False)
+
+def toy_block(channels):
+    if channels is None:
+        return None
+    return [None, SimpleNamespace(transformer_blocks=[SimpleNamespace(attn2=ToyCrossAttention(channels))])]
+
+class ToyModelPatcher:
+    """ModelPatcher stand-in holding an SD1-shaped UNet of attn2 modules"""
+    def __init__(self, diffusion_model=None):
+        if diffusion_model is None:
+            diffusion_model = SimpleNamespace(
+                dtype=torch.float32,
+                input_blocks=[toy_block(c) for c in INPUT_CHANNELS],
+                middle_block=toy_block(1280),
+                output_blocks=[toy_block(c) for c in OUTPUT_CHANNELS],
+            )
+        self.model = SimpleNamespace(diffusion_model=diffusion_model)
+        self.model_options = {"transformer_options": {}}
+
+    def clone(self):
+        clone = ToyModelPatcher(self.model.diffusion_model)
+        clone.model_options = copy.deepcopy(self.model_options)
+        return clone
+
+    def attn2(self, key):
+        unet = self.model.diffusion_model
+        if key[0] == "middle":
+            return unet.middle_block[1].transformer_blocks[0].attn2
+        blocks = unet.input_blocks if key[0] == "input" else unet.output_blocks
+        return blocks[key[1]][1].transformer_blocks[0].attn2
+
+# Original implementation, the reference for the equivalence checks
+
+def reference_get_masks_from_q(masks, q, original_shape):
+    if original_shape[2] * original_shape[3] == q.shape[1]:
+        down_sample_rate = 1
+    elif (original_shape[2] // 2) * (original_shape[3] // 2) == q.shape[1]:
+        down_sample_rate = 2
+    elif (original_shape[2] // 4) * (original_shape[3] // 4) == q.shape[1]:
+        down_sample_rate = 4
+    else:
+        down_sample_rate = 8
+
+    ret_masks = []
+    for mask in masks:
+        if isinstance(mask, torch.Tensor):
+            size = (original_shape[2] // down_sample_rate, original_shape[3] // down_sample_rate)
+            mask_downsample = F.interpolate(mask.unsqueeze(0), size=size, mode="nearest")
+            mask_downsample = mask_downsample.view(1, -1, 1).repeat(q.shape[0], 1, q.shape[2])
+            ret_masks.append(mask_downsample)
+        else:
+            ret_masks.append(torch.ones_like(q))
+    return torch.cat(ret_masks, dim=0)
+
+def reference_masks_and_conds(conditioning):
+    """Normalised full-size masks and contexts of one side, as the original node prepared them"""
+    if len(conditioning) == 1:
+        return [False], [conditioning[0][0]]
+    # ComfyUI masks are [1, H, W], RegionConditionMerge gives [H, W]
+    mask_norm = torch.stack([cond[1]["mask"].reshape(1, *cond[1]["mask"].shape[-2:]) * cond[1].get("mask_strength", 1.0)
+                             for cond in conditioning])
+    mask_norm = mask_norm / mask_norm.sum(dim=0)
+    return [mask_norm[i] for i in range(mask_norm.shape[0])], [cond[0] for cond in conditioning]
+
+def reference_patch(module, negative, positive):
+    negative_positive_masks, negative_positive_conds = zip(reference_masks_and_conds(negative),
+                                                           reference_masks_and_conds(positive))
+    len_neg, len_pos = len(negative), len(positive)
+
+    def patch(q, k, v, extra_options):
+        cond_or_uncond = extra_options["cond_or_uncond"]
+        q_list = q.chunk(len(cond_or_uncond), dim=0)
+        b = q_list[0].shape[0]
+
+        masks_uncond = reference_get_masks_from_q(negative_positive_masks[0], q_list[0], extra_options["original_shape"])
+        masks_cond = reference_get_masks_from_q(negative_positive_masks[1], q_list[0], extra_options["original_shape"])
+
+        context_uncond = torch.cat(negative_positive_conds[0], dim=0)
+        context_cond = torch.cat(negative_positive_conds[1], dim=0)
+        k_uncond, k_cond = module.to_k(context_uncond), module.to_k(context_cond)
+        v_uncond, v_cond = module.to_v(context_uncond), module.to_v(context_cond)
+
+        out = []
+        for i, c in enumerate(cond_or_uncond):
+            if c == 0:
+                masks, k, v, length = masks_cond, k_cond, v_cond, len_pos
+            else:
+                masks, k, v, length = masks_uncond, k_uncond, v_uncond, len_neg
+
+            q_target = q_list[i].repeat(length, 1, 1)
+            k = torch.cat([k[i].unsqueeze(0).repeat(b, 1, 1) for i in range(length)], dim=0)
+            v = torch.cat([v[i].unsqueeze(0).repeat(b, 1, 1) for i in range(length)], dim=0)
+
+            qkv = optimized_attention(q_target, k, v, extra_options["n_heads"])
+            qkv = qkv * masks
+            qkv = qkv.view(length, b, -1, module.heads * module.dim_head).sum(dim=0)
+            out.append(qkv)
+        return torch.cat(out, dim=0)
+    return patch
+
+# Measurement
+
+def latency_ms(run, repeat):
+    run() # warm-up, fills the per-resolution caches
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+def peak_bytes(run):
+    """High-water mark of the tensor memory allocated during one call, None if not recorded"""
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        run()
+    # Every allocation and free is a "[memory]" event in the raw results, the function events
+    # only keep the ones made outside an operator
+    kineto_results = getattr(prof.profiler, "kineto_results", None)
+    if kineto_results is None:
+        return None
+    events = sorted((e for e in kineto_results.events() if e.name() == "[memory]"), key=lambda e: e.start_ns())
+    if not events:
+        return None
+    live = peak = 0
+    for event in events:
+        live += event.nbytes()
+        peak = max(peak, live)
+    return peak
+
+def max_abs_diff(a, b):
+    return float((a.float() - b.float()).abs().max())
+
+# Cases
+
+def make_specs(regions, seed):
+    """A full-canvas background region plus regions - 1 random rectangles"""
+    generator = torch.Generator().manual_seed(seed)
+    specs = []
+    for index in range(regions):
+        conditioning = [[torch.randn(1, CONTEXT_TOKENS, CONTEXT_DIM, generator=generator), {}]]
+        if index == 0:
+            x, y, w, h = 0.0, 0.0, 1.0, 1.0
+        else:
+            x, y = (torch.rand(2, generator=generator) * 0.7).tolist()
+            w, h = (0.15 + torch.rand(2, generator=generator) * 0.3).tolist()
+        specs.append({'conditioning': conditioning, 'mode': 'pct', 'x': x, 'y': y, 'w': w, 'h': h, 'strength': 1.0})
+    return specs
+
+def bench_merge(specs, resolution, repeat):
+    node = RegionConditionMerge()
+    inputs = {f"region_spec_{index + 1}": spec for index, spec in enumerate(specs)}
+
+    def cold():
+        region_conditioning_nodes.region_mask_cache.clear()
+        return node.merge_regions(resolution, resolution, **inputs)
+
+    def warm():
+        return node.merge_regions(resolution, resolution, **inputs)
+
+    return [
+        {"target": "merge[cold]", "latency_ms": latency_ms(cold, repeat), "peak_bytes": peak_bytes(cold)},
+        {"target": "merge[warm]", "latency_ms": latency_ms(warm, repeat), "peak_bytes": peak_bytes(warm)},
+    ]
+
+def bench_masks(positive, reference_positive, resolution, batch, repeat):
+    latent = resolution // 8
+    original_shape = [2 * batch, 4, latent, latent]
+    geometry = attention_couple.RegionGeometry([cond[1]["region"] for cond in positive],
+                                               [cond[1].get("mask_strength", 1.0) for cond in positive])
+    legacy_masks, _ = reference_masks_and_conds(reference_positive)
+    records = []
+    for key, rate, channels in BENCH_BLOCKS:
+        q = torch.zeros(batch, (latent // rate) ** 2, channels)
+        masks = get_masks_from_q(geometry, q, original_shape)
+        reference = reference_get_masks_from_q(legacy_masks, q, original_shape)
+        reference = reference.view(len(positive), batch, -1, channels)[:, 0, :, 0]
+        records.append({
+            "target": "masks", "rate": rate, "tokens": q.shape[1],
+            "latency_ms": latency_ms(lambda: get_masks_from_q(geometry, q, original_shape), repeat),
+            "reference_latency_ms": latency_ms(lambda: reference_get_masks_from_q(legacy_masks, q, original_shape), repeat),
+            "peak_bytes": peak_bytes(lambda: get_masks_from_q(geometry, q, original_shape)),
+            "max_abs_diff": max_abs_diff(masks.view(len(positive), -1), reference),
+        })
+    return records
+
+def bench_patch(model, positive, reference_positive, negative, resolution, batch, modes, chunk_sizes, repeat):
+    latent = resolution // 8
+    extra_options = {"cond_or_uncond": [1, 0], "original_shape": [2 * batch, 4, latent, latent], "n_heads": HEADS}
+    generator = torch.Generator().manual_seed(resolution * 31 + batch)
+    records = []
+    with torch.inference_mode():
+        queries = {rate: torch.randn(2 * batch, (latent // rate) ** 2, channels, generator=generator)
+                   for _, rate, channels in BENCH_BLOCKS}
+        references = {}
+        for key, rate, _ in BENCH_BLOCKS:
+            q = queries[rate]
+            reference = reference_patch(model.attn2(key), negative, reference_positive)
+            references[key] = (reference(q, q, q, extra_options),
+                               latency_ms(lambda: reference(q, q, q, extra_options), repeat),
+                               peak_bytes(lambda: reference(q, q, q, extra_options)))
+            records.append({"target": "patch[reference]", "rate": rate, "tokens": q.shape[1],
+                            "latency_ms": references[key][1], "peak_bytes": references[key][2]})
+
+        for mode in modes:
+            for chunk_size in chunk_sizes:
+                patched, _, _ = AttentionCouple().attention_couple(model, positive, negative, "Attention",
+                                                                   attention_mode=mode, region_chunk_size=chunk_size)
+                patches = patched.model_options["transformer_options"]["patches_replace"]["attn2"]
+                for key, rate, _ in BENCH_BLOCKS:
+                    q = queries[rate]
+                    patch = patches[key]
+                    latency = latency_ms(lambda: patch(q, q, q, extra_options), repeat)
+                    records.append({
+                        "target": f"patch[{mode}]", "chunk_size": chunk_size, "rate": rate, "tokens": q.shape[1],
+                        "latency_ms": latency,
+                        "peak_bytes": peak_bytes(lambda: patch(q, q, q, extra_options)),
+                        "speedup": references[key][1] / latency,
+                        "max_abs_diff": max_abs_diff(patch(q, q, q, extra_options), references[key][0]),
+                    })
+    return records
+
+def run_config(model, regions, resolution, batch, args):
+    # ComfyUI runs every node under inference mode, so conditioning and masks are inference tensors
+    with torch.inference_mode():
+        specs = make_specs(regions, seed=regions * 1000 + resolution)
+        inputs = {f"region_spec_{index + 1}": spec for index, spec in enumerate(specs)}
+        positive = RegionConditionMerge().merge_regions(resolution, resolution, **inputs)[0]
+        # The original implementation only ever saw canvas-size masks
+        reference_positive = RegionConditionMerge().merge_regions(resolution, resolution, mask_resolution="full", **inputs)[0]
+        negative = [[torch.zeros(1, CONTEXT_TOKENS, CONTEXT_DIM), {}]]
+
+    records = bench_merge(specs, resolution, args.repeat)
+    records += bench_masks(positive, reference_positive, resolution, batch, args.repeat)
+    records += bench_patch(model, positive, reference_positive, negative, resolution, batch, args.modes, args.chunk_sizes, args.repeat)
+    for record in records:
+        record.update({"regions": regions, "resolution": resolution, "batch": batch})
+        if "max_abs_diff" in record:
+            record["equivalent"] = record["max_abs_diff"] <= args.atol
+    return records
+
+def print_records(records):
+    for r in records:
+        line = (f"R={r['regions']:<3} {r['resolution']:>5}px b={r['batch']} {r['target']:<18}"
+                f"{'' if 'rate' not in r else ' x' + str(r['rate']):<4}"
+                f"{'' if not r.get('chunk_size') else ' chunk ' + str(r['chunk_size']):<10}"
+                f" {r['latency_ms']:>9.3f} ms")
+        if r.get("peak_bytes") is not None:
+            line += f" peak {r['peak_bytes'] / (1024 * 1024):>8.1f} MB"
+        if "speedup" in r:
+            line += f" {r['speedup']:>5.2f}x"
+        if "max_abs_diff" in r:
+            line += f" diff {r['max_abs_diff']:.2e}{'' if r['equivalent'] else ' MISMATCH'}"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--regions", type=int, nargs="+", default=[2, 4, 8])
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[512, 768], help="Square image sizes in pixels, multiples of 64")
+    parser.add_argument("--batches", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--modes", nargs="+", default=["standard", "sparse"], choices=["standard", "sparse"])
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[0], help="region_chunk_size values, 0 processes all regions at once")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, help="torch.set_num_threads")
+    parser.add_argument("--atol", type=float, default=1e-4, help="Largest absolute difference counted as equivalent")
+    parser.add_argument("--json", help="Write results to this file")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    # One toy UNet for every configuration, the prepared patches only hold references to it
+    # Created under inference mode like the models ComfyUI loads, its weights are inference tensors
+    with torch.inference_mode():
+        model = ToyModelPatcher()
+    # Unrecorded pass so thread pools and allocator caches are warm before the first configuration
+    run_config(model, min(args.regions), min(args.resolutions), min(args.batches), argparse.Namespace(**{**vars(args), "repeat": 1}))
+    records = []
+    for regions in args.regions:
+        for resolution in args.resolutions:
+            for batch in args.batches:
+                config_records = run_config(model, regions, resolution, batch, args)
+                print_records(config_records)
+                records += config_records
+
+    mismatches = [r for r in records if r.get("equivalent") is False]
+    if mismatches:
+        print(f"{len(mismatches)} results differ from the original implementation by more than {args.atol}")
+
+    if args.json:
+        report = {
+            "benchmark": "region_attention",
+            "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                            "torch": torch.__version__, "threads": torch.get_num_threads()},
+            "parameters": {k: getattr(args, k) for k in ("regions", "resolutions", "batches", "modes", "chunk_sizes", "repeat", "atol")},
+            "results": records,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
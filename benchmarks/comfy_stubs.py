@@ -0,0 +1,128 @@
+"""
+Minimal stand-ins for the ComfyUI modules the nodes import, so benchmarks can
+run headless without a ComfyUI checkout. Real modules are used when importable.
+"""
+
+import os
+import sys
+import types
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _node_helpers():
+    module = types.ModuleType("node_helpers")
+
+    def pillow(fn, arg):
+        return fn(arg)
+
+    module.pillow = pillow
+    return module
+
+def _folder_paths(base_dir):
+    module = types.ModuleType("folder_paths")
+    module.base_dir = base_dir
+
+    def get_input_directory():
+        return os.path.join(module.base_dir, "input")
+
+    def get_user_directory():
+        return os.path.join(module.base_dir, "user")
+
+    def get_annotated_filepath(name):
+        # "name [input]" style annotations all resolve to the input directory here
+        if name.endswith("]") and " [" in name:
+            name = name[:name.rindex(" [")]
+        return os.path.join(get_input_directory(), name)
+
+    def exists_annotated_filepath(name):
+        return os.path.exists(get_annotated_filepath(name))
+
+    def filter_files_content_types(files, content_types):
+        extensions = {
+            "image": (".jpg", ".jpeg", ".png", ".bmp", ".gif", ".tiff", ".tif", ".webp"),
+            "video": (".mp4", ".avi", ".mov", ".mkv", ".webm"),
+        }
+        allowed = tuple(ext for content_type in content_types for ext in extensions.get(content_type, ()))
+        return [f for f in files if f.lower().endswith(allowed)]
+
+    module.get_input_directory = get_input_directory
+    module.get_user_directory = get_user_directory
+    module.get_annotated_filepath = get_annotated_filepath
+    module.exists_annotated_filepath = exists_annotated_filepath
+    module.filter_files_content_types = filter_files_content_types
+    return module
+
+def _comfy_utils():
+    module = types.ModuleType("comfy.utils")
+
+    def common_upscale(samples, width, height, upscale_method, crop):
+        # [N, C, H, W]; lanczos has no torch equivalent, bicubic is close enough for timing
+        import torch.nn.functional as F
+        mode = {"lanczos": "bicubic", "nearest-exact": "nearest-exact", "area": "area"}.get(upscale_method, upscale_method)
+        kwargs = {} if mode in ("area", "nearest-exact", "nearest") else {"align_corners": False}
+        return F.interpolate(samples, size=(height, width), mode=mode, **kwargs)
+
+    module.common_upscale = common_upscale
+    return module
+
+def _comfy_model_management():
+    module = types.ModuleType("comfy.model_management")
+
+    def get_torch_device():
+        import torch
+        return torch.device("cpu")
+
+    module.get_torch_device = get_torch_device
+    return module
+
+def _comfy_attention():
+    module = types.ModuleType("comfy.ldm.modules.attention")
+
+    def optimized_attention(q, k, v, heads, mask=None, attn_precision=None, skip_reshape=False, skip_output_reshape=False):
+        # [b, tokens, heads * dim_head] in and out, like ComfyUI's attention_pytorch
+        import torch.nn.functional as F
+        b, _, inner_dim = q.shape
+        dim_head = inner_dim // heads
+        q, k, v = (t.view(b, -1, heads, dim_head).transpose(1, 2) for t in (q, k, v))
+        if mask is not None:
+            # [tokens, ctx] or [b, tokens, ctx] masks broadcast over the batch and heads
+            if mask.ndim == 2:
+                mask = mask.unsqueeze(0)
+            if mask.ndim == 3:
+                mask = mask.unsqueeze(1)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+        return out.transpose(1, 2).reshape(b, -1, inner_dim)
+
+    module.optimized_attention = optimized_attention
+    return module
+
+def _register(name, module):
+    """Add a stand-in to sys.modules, creating empty parent packages as needed"""
+    parent_name, _, child = name.rpartition(".")
+    if parent_name:
+        parent = sys.modules.get(parent_name)
+        if parent is None:
+            parent = types.ModuleType(parent_name)
+            parent.__path__ = []
+            _register(parent_name, parent)
+        setattr(parent, child, module)
+    sys.modules[name] = module
+
+def install(base_dir=None):
+    """Register stand-ins for missing ComfyUI modules and make the repo importable"""
+    if base_dir is None:
+        base_dir = os.path.join(REPO_ROOT, ".bench")
+    stubs = {
+        "node_helpers": _node_helpers,
+        "folder_paths": lambda: _folder_paths(base_dir),
+        "comfy.utils": _comfy_utils,
+        "comfy.model_management": _comfy_model_management,
+        "comfy.ldm.modules.attention": _comfy_attention,
+    }
+    for name, factory in stubs.items():
+        try:
+            __import__(name)
+        except ImportError:
+            _register(name, factory())
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
@@ -1,36 +1,118 @@
+import os
+import json
+import time
+import logging
+import threading
+import weakref
 import torch
 import torch.nn.functional as F
-import copy
 import comfy
 from comfy.ldm.modules.attention import optimized_attention
+from .region_conditioning_nodes import rasterize_rects
+from .metrics import tensor_bytes
+from .profiling import profiled
 
 """Node taken from https://github.com/laksjdjf/attention-couple-ComfyUI"""
 
+logger = logging.getLogger(__name__)
 
+# Opt-in per-block timing of the attn2 patches, also enabled by the node's instrument input
+ATTENTION_STATS_ENV = "CUSTOMNODES_ATTENTION_STATS"
+# Optional JSON lines file each sampling run's block statistics are appended to
+ATTENTION_STATS_FILE_ENV = "CUSTOMNODES_ATTENTION_STATS_FILE"
+ATTENTION_STATS_WRAPPER_KEY = "attention_couple_stats"
+
+
+class RegionGeometry:
+    """
+    Region rectangles of one side (positive or negative) from RegionConditionMerge,
+    rasterised and normalised directly at each attention resolution.
+    """
+    def __init__(self, regions, strengths):
+        self.rects = torch.tensor([[r['x'], r['y'], r['x'] + r['w'], r['y'] + r['h']] for r in regions], dtype=torch.float64)
+        self.canvas = torch.tensor([r['canvas'] for r in regions], dtype=torch.float64)
+        self.strengths = torch.tensor([float(r['strength']) * s for r, s in zip(regions, strengths)], dtype=torch.float32)
+        self.feather = max(r.get('feather', 0) for r in regions)
+
+    def __len__(self):
+        return len(self.strengths)
+
+    def masks(self, height, width):
+        masks = rasterize_rects(self.rects, self.strengths, self.canvas, height, width, self.feather)
+        return masks / masks.sum(dim=0) # 合計が1になるように正規化
+
+def is_region_geometry_current(options):
+    """Whether the RegionConditionMerge geometry of a conditioning entry still describes its mask"""
+    region = options.get("region")
+    return region is not None and region.get("mask") is not None and region["mask"] is options.get("mask")
+
+def get_attention_size(original_shape, tokens):
+    """Spatial size of the attention input, the UNet rounds odd sizes up when downsampling"""
+    height, width = original_shape[2], original_shape[3]
+    for down_sample_rate in (1, 2, 4, 8):
+        ceil_size = ((height + down_sample_rate - 1) // down_sample_rate, (width + down_sample_rate - 1) // down_sample_rate)
+        floor_size = (height // down_sample_rate, width // down_sample_rate)
+        for size in (ceil_size, floor_size):
+            if size[0] * size[1] == tokens:
+                return size
+    return (height // 8, width // 8)
 
 def get_masks_from_q(masks, q, original_shape):
+    """
+    Region masks at the attention resolution of q, shaped [length, 1, tokens, 1] so they
+    broadcast over batch and channels. Returns None when the side has no coupling.
+    """
+    size = get_attention_size(original_shape, q.shape[1])
+
+    if isinstance(masks, RegionGeometry):
+        # Rectangles are rasterised exactly at this resolution, no full-size mask to interpolate
+        region_masks = masks.masks(size[0], size[1])
+    elif isinstance(masks[0], torch.Tensor):
+        region_masks = torch.stack([mask.reshape(mask.shape[-2:]) for mask in masks]).unsqueeze(1)
+        region_masks = F.interpolate(region_masks, size=size, mode="nearest")
+    else: # coupling処理なしの場合
+        return None
 
-    if original_shape[2] * original_shape[3] == q.shape[1]:
-        down_sample_rate = 1
-    elif (original_shape[2] // 2) * (original_shape[3] // 2) == q.shape[1]:
-        down_sample_rate = 2
-    elif (original_shape[2] // 4) * (original_shape[3] // 4) == q.shape[1]:
-        down_sample_rate = 4
-    else:
-        down_sample_rate = 8
-
-    ret_masks = []
-    for mask in masks:
-        if isinstance(mask,torch.Tensor):
-            size = (original_shape[2] // down_sample_rate, original_shape[3] // down_sample_rate)
-            mask_downsample = F.interpolate(mask.unsqueeze(0), size=size, mode="nearest")
-            mask_downsample = mask_downsample.view(1,-1, 1).repeat(q.shape[0], 1, q.shape[2])
-            ret_masks.append(mask_downsample)
-        else: # coupling処理なしの場合
-            ret_masks.append(torch.ones_like(q))
-    
-    ret_masks = torch.cat(ret_masks, dim=0)
-    return ret_masks
+    return region_masks.to(q.device, dtype=q.dtype).view(len(masks), 1, -1, 1)
+
+def get_region_boxes(masks, size):
+    """
+    Bounding boxes (top, bottom, left, right) of the nonzero area of each [length, 1, tokens, 1]
+    region mask at the attention size, None for regions that are empty at this resolution.
+    """
+    support = (masks.view(masks.shape[0], size[0], size[1]) != 0).cpu()
+    rows = support.any(dim=2)
+    cols = support.any(dim=1)
+    boxes = []
+    for region_rows, region_cols in zip(rows, cols):
+        ys = region_rows.nonzero()
+        xs = region_cols.nonzero()
+        if len(ys) == 0:
+            boxes.append(None)
+        else:
+            boxes.append((int(ys[0]), int(ys[-1]) + 1, int(xs[0]), int(xs[-1]) + 1))
+    return boxes
+
+def sparse_regional_attention(q, k, v, masks, boxes, size, heads):
+    """
+    Regional attention that only evaluates the queries inside each region's box.
+    q [b, tokens, C], k/v [length * b, ctx, C] region-major, masks [length, 1, tokens, 1].
+    Cross-attention queries are independent, so cropping gives the same values as the full
+    attention everywhere the mask is nonzero, and empty regions are skipped entirely.
+    """
+    b, tokens, channels = q.shape
+    q_grid = q.reshape(b, size[0], size[1], channels)
+    out = torch.zeros_like(q)
+    out_grid = out.view(b, size[0], size[1], channels)
+    for r, box in enumerate(boxes):
+        if box is None:
+            continue
+        top, bottom, left, right = box
+        q_region = q_grid[:, top:bottom, left:right].reshape(b, -1, channels)
+        mask_region = masks[r].view(size[0], size[1])[top:bottom, left:right].reshape(1, -1, 1)
+        qkv = optimized_attention(q_region, k[r * b:(r + 1) * b], v[r * b:(r + 1) * b], heads)
+        out_grid[:, top:bottom, left:right] += (qkv * mask_region).view(b, bottom - top, right - left, channels)
+    return out
 
 def set_model_patch_replace(model, patch, key):
     to = model.model_options["transformer_options"]
@@ -40,6 +122,262 @@ def set_model_patch_replace(model, patch, key):
         to["patches_replace"]["attn2"] = {}
     to["patches_replace"]["attn2"][key] = patch
 
+class PatchStats:
+    """Call count, wall time and tensor sizes per patched block, reported once per sampling run"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.blocks = {}
+
+    def reset(self):
+        with self.lock:
+            self.blocks = {}
+
+    def record(self, key, seconds, q, k, v, out, peak_bytes=None):
+        """peak_bytes is the measured allocation above the start of the call, None if it wasn't measured"""
+        with self.lock:
+            entry = self.blocks.get(key)
+            if entry is None:
+                entry = self.blocks[key] = {"calls": 0, "seconds": 0.0, "tensor_bytes": 0, "out_bytes": 0, "peak_bytes": None}
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["q_shape"] = list(q.shape)
+            entry["k_shape"] = list(k.shape)
+            entry["v_shape"] = list(v.shape)
+            entry["tensor_bytes"] += tensor_bytes(q, k, v, out)
+            entry["out_bytes"] = max(entry["out_bytes"], tensor_bytes(out))
+            if peak_bytes is not None:
+                entry["peak_bytes"] = max(entry["peak_bytes"] or 0, peak_bytes)
+
+    def report(self):
+        """Log a summary table of the run and append it to the stats file if configured"""
+        with self.lock:
+            blocks, self.blocks = self.blocks, {}
+        if not blocks:
+            return
+
+        total = sum(entry["seconds"] for entry in blocks.values())
+        lines = [f"{'block':<22} {'calls':>6} {'total ms':>10} {'mean ms':>8} {'share':>6} {'q shape':<18} {'out MB':>7} {'peak MB':>8}"]
+        for key, entry in sorted(blocks.items(), key=lambda item: -item[1]["seconds"]):
+            # Peaks are only measured on CUDA devices
+            peak = "-" if entry["peak_bytes"] is None else f"{entry['peak_bytes'] / (1024 * 1024):.1f}"
+            lines.append(f"{str(key):<22} {entry['calls']:>6} {entry['seconds'] * 1000:>10.2f} "
+                         f"{entry['seconds'] * 1000 / entry['calls']:>8.3f} {entry['seconds'] / max(total, 1e-12):>6.1%} "
+                         f"{'x'.join(map(str, entry['q_shape'])):<18} {entry['out_bytes'] / (1024 * 1024):>7.1f} {peak:>8}")
+        lines.append(f"total {total * 1000:.2f} ms over {sum(entry['calls'] for entry in blocks.values())} calls")
+        logger.info("AttentionCouple patch statistics for this sampling run:\n%s", "\n".join(lines))
+
+        stats_file = os.environ.get(ATTENTION_STATS_FILE_ENV, "").strip()
+        if stats_file:
+            record = {
+                "time": time.time(),
+                "total_seconds": total,
+                "blocks": [{"key": list(key), **entry} for key, entry in blocks.items()],
+            }
+            with open(stats_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+# (positive identity, negative identity, dtype, device, options) -> CoupleState. Entries only live
+# while the attn2 patches of a patched model reference the state, nothing here holds models or
+# device tensors on its own
+prepared_states = weakref.WeakValueDictionary()
+prepared_states_lock = threading.Lock()
+
+def tensor_version(tensor):
+    """In-place modification counter of a tensor, None for inference tensors which don't track one"""
+    return None if tensor.is_inference() else tensor._version
+
+def conditioning_identity(conditioning):
+    """
+    Key of the tensors and options of a conditioning that a CoupleState is prepared from, and
+    those tensors. Tensor ids are only unique while the tensors are alive. ComfyUI creates
+    conditioning under inference mode, those tensors are matched by identity alone.
+    """
+    key = []
+    tensors = []
+    for t in conditioning:
+        options = t[1]
+        entry = [id(t[0]), tensor_version(t[0]), options.get("mask_strength", 1.0)]
+        tensors.append(t[0])
+        mask = options.get("mask")
+        if mask is not None:
+            entry += [id(mask), tensor_version(mask)]
+            tensors.append(mask)
+        if is_region_geometry_current(options):
+            region = options["region"]
+            entry.append(tuple(region.get(k) for k in ("x", "y", "w", "h", "canvas", "strength", "feather")))
+        key.append(tuple(entry))
+    return tuple(key), tensors
+
+def coupled_output(conditioning):
+    """First entry of a conditioning, without the mask when the couple replaces latent coupling"""
+    options = conditioning[0][1].copy()
+    if len(conditioning) != 1:
+        options.pop("mask", None) # latent coupleの無効化のため
+        options.pop("mask_strength", None)
+        options.pop("region", None)
+    return [[conditioning[0][0], options]]
+
+class CoupleState:
+    """
+    Prepared masks and contexts of one AttentionCouple input, shared read-only by its attn2
+    patches. The caches only memoise values derived from the fields, which are never reassigned.
+    The device copies of the contexts and masks belong to the state, they are freed with the
+    patched models referencing it.
+    """
+    def __init__(self, negative_positive_masks, negative_positive_conds, conditioning_length, attention_mode, region_chunk_size, stats=None, sources=()):
+        # Weak references to the input tensors the state was prepared from
+        self.sources = tuple(weakref.ref(t) for t in sources)
+        self.negative_positive_masks = tuple(negative_positive_masks)
+        self.negative_positive_conds = tuple(tuple(conds) for conds in negative_positive_conds)
+        self.conditioning_length = conditioning_length
+        self.attention_mode = attention_mode
+        self.region_chunk_size = region_chunk_size
+        # PatchStats when instrumentation is enabled
+        self.stats = stats
+        # (side, latent size, tokens, device, dtype) -> masks, they only depend on the resolution
+        self.mask_cache = {}
+        self.box_cache = {}
+
+    def prepared_from(self, tensors):
+        """Whether the state was prepared from exactly these (alive) tensors"""
+        return len(tensors) == len(self.sources) and all(ref() is t for ref, t in zip(self.sources, tensors))
+
+    def get_masks(self, side, q, original_shape):
+        """Masks of one side (0: negative, 1: positive) for q, computed once per resolution"""
+        key = (side, tuple(original_shape[2:]), q.shape[1], q.device, q.dtype)
+        if key not in self.mask_cache:
+            self.mask_cache[key] = get_masks_from_q(self.negative_positive_masks[side], q, original_shape)
+        return self.mask_cache[key]
+
+    def get_boxes(self, side, q, original_shape):
+        """Region bounding boxes of one side for q, computed once per resolution"""
+        key = (side, tuple(original_shape[2:]), q.shape[1])
+        if key not in self.box_cache:
+            masks = self.get_masks(side, q, original_shape)
+            size = get_attention_size(original_shape, q.shape[1])
+            self.box_cache[key] = None if masks is None else (size, get_region_boxes(masks, size))
+        return self.box_cache[key]
+
+    def make_patch(self, module, block_key=None):
+        # Projected and batch-expanded K/V of both sides, keyed by (batch size, dtype, device)
+        # The contexts never change during sampling, so they are projected once per key
+        kv_cache = {}
+
+        def get_kv(b, dtype, device):
+            # Weights replaced (e.g. LoRA patching) invalidate the cache, as does in-place modification
+            # of weights that track a version counter. Weights loaded under inference mode don't
+            weights = (getattr(module.to_k, "weight", None), getattr(module.to_v, "weight", None))
+            weights_token = tuple(None if w is None else (id(w), w.data_ptr(), tensor_version(w)) for w in weights)
+            cached = kv_cache.get((b, dtype, device))
+            if cached is not None and cached[0] == weights_token:
+                return cached[1]
+
+            kv = []
+            for conds in self.negative_positive_conds:
+                context = torch.cat(conds, dim=0)
+                # [length * b, tokens, C], region-major like the masks
+                k = module.to_k(context).repeat_interleave(b, dim=0)
+                v = module.to_v(context).repeat_interleave(b, dim=0)
+                kv.append((k, v))
+            kv_cache[(b, dtype, device)] = (weights_token, kv)
+            return kv
+
+        def patch(q, k, v, extra_options):
+            
+            len_neg, len_pos = self.conditioning_length # negative, positiveの長さ
+            cond_or_uncond = extra_options["cond_or_uncond"] # 0: cond, 1: uncond
+            q_list = q.chunk(len(cond_or_uncond), dim=0)
+            b = q_list[0].shape[0] # batch_size
+            
+            masks_uncond = self.get_masks(0, q_list[0], extra_options["original_shape"])
+            masks_cond = self.get_masks(1, q_list[0], extra_options["original_shape"])
+
+            (k_uncond, v_uncond), (k_cond, v_cond) = get_kv(b, q.dtype, q.device)
+
+            out = []
+            for i, c in enumerate(cond_or_uncond):
+                if c == 0:
+                    masks = masks_cond
+                    k = k_cond
+                    v = v_cond
+                    length = len_pos
+                else:
+                    masks = masks_uncond
+                    k = k_uncond
+                    v = v_uncond
+                    length = len_neg
+
+                if self.attention_mode == "sparse" and masks is not None:
+                    size, boxes = self.get_boxes(1 if c == 0 else 0, q_list[i], extra_options["original_shape"])
+                    out.append(sparse_regional_attention(q_list[i], k, v, masks, boxes, size, extra_options["n_heads"]))
+                    continue
+
+                # Regions are attended chunk_size at a time and their masked sum accumulated in place
+                chunk_size = self.region_chunk_size if self.region_chunk_size > 0 else length
+                qkv_sum = None
+                for start in range(0, length, chunk_size):
+                    end = min(start + chunk_size, length)
+                    q_target = q_list[i].repeat(end - start, 1, 1)
+
+                    qkv = optimized_attention(q_target, k[start * b:end * b], v[start * b:end * b], extra_options["n_heads"])
+                    del q_target
+                    qkv = qkv.view(end - start, b, -1, module.heads * module.dim_head)
+                    if masks is not None:
+                        qkv.mul_(masks[start:end]) # [chunk, 1, tokens, 1] broadcasts over batch and channels
+                    qkv = qkv.sum(dim=0)
+
+                    if qkv_sum is None:
+                        qkv_sum = qkv
+                    else:
+                        qkv_sum.add_(qkv)
+
+                out.append(qkv_sum)
+
+            out = torch.cat(out, dim=0)
+            return out
+
+        if self.stats is None:
+            return patch
+
+        def instrumented_patch(q, k, v, extra_options):
+            cuda = q.device.type == "cuda"
+            if cuda:
+                # Synchronise so the wall time covers the kernels of this block only
+                torch.cuda.synchronize(q.device)
+                # The device-wide peak isn't reset, other users of the statistics keep theirs. A call
+                # that raises it peaked at the new value, otherwise its peak stays below the old one
+                allocated = torch.cuda.memory_allocated(q.device)
+                previous_peak = torch.cuda.max_memory_allocated(q.device)
+            start = time.perf_counter()
+            out = patch(q, k, v, extra_options)
+            peak_bytes = None
+            if cuda:
+                torch.cuda.synchronize(q.device)
+                peak = torch.cuda.max_memory_allocated(q.device)
+                peak_bytes = peak - allocated if peak > previous_peak else None
+            self.stats.record(block_key, time.perf_counter() - start, q, k, v, out, peak_bytes)
+            return out
+        return instrumented_patch
+
+def add_stats_wrapper(model, stats):
+    """Report the patch statistics at the end of every sampling run of model"""
+    try:
+        import comfy.patcher_extension as patcher_extension
+    except ImportError:
+        patcher_extension = None
+    if patcher_extension is None or not hasattr(model, "add_wrapper_with_key"):
+        logger.warning("AttentionCouple instrumentation needs a ComfyUI version with sampling wrappers, statistics won't be reported")
+        return
+
+    def report_stats(executor, *args, **kwargs):
+        stats.reset()
+        try:
+            return executor(*args, **kwargs)
+        finally:
+            stats.report()
+
+    model.add_wrapper_with_key(patcher_extension.WrappersMP.OUTER_SAMPLE, ATTENTION_STATS_WRAPPER_KEY, report_stats)
+
 class AttentionCouple:
 
     @classmethod
@@ -50,111 +388,111 @@ class AttentionCouple:
                 "positive": ("CONDITIONING",),
                 "negative": ("CONDITIONING",),
                 "mode": (["Attention", "Latent"], ),
+            },
+            "optional": {
+                "attention_mode": (["standard", "sparse"], {"default": "standard", "tooltip": "sparse only attends the queries inside each region's bounding box and skips empty regions"}),
+                "region_chunk_size": ("INT", {"default": 0, "min": 0, "max": 1024, "step": 1, "tooltip": "Number of regions attended at a time, bounds peak memory by the chunk size instead of the region count. 0 processes all regions at once"}),
+                "instrument": ("BOOLEAN", {"default": False, "tooltip": f"Log per-block call counts, time and tensor sizes of the regional attention after each sampling run, also enabled by {ATTENTION_STATS_ENV}=1"}),
             }
         }
     RETURN_TYPES = ("MODEL", "CONDITIONING", "CONDITIONING")
     FUNCTION = "attention_couple"
     CATEGORY = "loaders"
 
-    def attention_couple(self, model, positive, negative, mode):
+    @profiled("attention_couple")
+    def attention_couple(self, model, positive, negative, mode, attention_mode="standard", region_chunk_size=0, instrument=False):
         if mode == "Latent":
             return (model, positive, negative) # latent coupleの場合は何もしない
         
-        self.negative_positive_masks = []
-        self.negative_positive_conds = []
-        
-        new_positive = copy.deepcopy(positive)
-        new_negative = copy.deepcopy(negative)
-        
+        instrument = instrument or os.environ.get(ATTENTION_STATS_ENV, "").strip() not in ("", "0")
+
         dtype = model.model.diffusion_model.dtype
         device = comfy.model_management.get_torch_device()
-        
-        # maskとcondをリストに格納する
-        for conditions in [new_negative, new_positive]:
-            conditions_masks = []
-            conditions_conds = []
-            if len(conditions) != 1:
-                mask_norm = torch.stack([cond[1]["mask"].to(device, dtype=dtype) * cond[1]["mask_strength"] for cond in conditions])
-                mask_norm = mask_norm / mask_norm.sum(dim=0) # 合計が1になるように正規化(他が0の場合mask_strengthの効果がなくなる)
-                conditions_masks.extend([mask_norm[i] for i in range(mask_norm.shape[0])])
-                conditions_conds.extend([cond[0].to(device, dtype=dtype) for cond in conditions])
-                del conditions[0][1]["mask"] # latent coupleの無効化のため
-                del conditions[0][1]["mask_strength"]
-            else:
-                conditions_masks = [False]
-                conditions_conds = [conditions[0][0].to(device, dtype=dtype)]
-            self.negative_positive_masks.append(conditions_masks)
-            self.negative_positive_conds.append(conditions_conds)
-        self.conditioning_length = (len(new_negative), len(new_positive))
+        state = self.get_state(positive, negative, dtype, device, attention_mode, region_chunk_size, instrument)
 
+        # Cloning and registering the patches is cheap, only the prepared state is reused
         new_model = model.clone()
-        self.sdxl = hasattr(new_model.model.diffusion_model, "label_emb")
-        if not self.sdxl:
+        if state.stats is not None:
+            add_stats_wrapper(new_model, state.stats)
+
+        def patch_block(attn2, key):
+            set_model_patch_replace(new_model, state.make_patch(attn2, key), key)
+
+        sdxl = hasattr(new_model.model.diffusion_model, "label_emb")
+        if not sdxl:
             for id in [1,2,4,5,7,8]: # id of input_blocks that have cross attention
-                set_model_patch_replace(new_model, self.make_patch(new_model.model.diffusion_model.input_blocks[id][1].transformer_blocks[0].attn2), ("input", id))
-            set_model_patch_replace(new_model, self.make_patch(new_model.model.diffusion_model.middle_block[1].transformer_blocks[0].attn2), ("middle", 0))
+                patch_block(new_model.model.diffusion_model.input_blocks[id][1].transformer_blocks[0].attn2, ("input", id))
+            patch_block(new_model.model.diffusion_model.middle_block[1].transformer_blocks[0].attn2, ("middle", 0))
             for id in [3,4,5,6,7,8,9,10,11]: # id of output_blocks that have cross attention
-                set_model_patch_replace(new_model, self.make_patch(new_model.model.diffusion_model.output_blocks[id][1].transformer_blocks[0].attn2), ("output", id))
+                patch_block(new_model.model.diffusion_model.output_blocks[id][1].transformer_blocks[0].attn2, ("output", id))
         else:
             for id in [4,5,7,8]: # id of input_blocks that have cross attention
                 block_indices = range(2) if id in [4, 5] else range(10) # transformer_depth
                 for index in block_indices:
-                    set_model_patch_replace(new_model, self.make_patch(new_model.model.diffusion_model.input_blocks[id][1].transformer_blocks[index].attn2), ("input", id, index))
+                    patch_block(new_model.model.diffusion_model.input_blocks[id][1].transformer_blocks[index].attn2, ("input", id, index))
             for index in range(10):
-                set_model_patch_replace(new_model, self.make_patch(new_model.model.diffusion_model.middle_block[1].transformer_blocks[index].attn2), ("middle", id, index))
+                patch_block(new_model.model.diffusion_model.middle_block[1].transformer_blocks[index].attn2, ("middle", id, index))
             for id in range(6): # id of output_blocks that have cross attention
                 block_indices = range(2) if id in [3, 4, 5] else range(10) # transformer_depth
                 for index in block_indices:
-                    set_model_patch_replace(new_model, self.make_patch(new_model.model.diffusion_model.output_blocks[id][1].transformer_blocks[index].attn2), ("output", id, index))
+                    patch_block(new_model.model.diffusion_model.output_blocks[id][1].transformer_blocks[index].attn2, ("output", id, index))
         
-        return (new_model, [new_positive[0]], [new_negative[0]]) # pool outputは・・・後回し
-    
-    def make_patch(self, module):
-        def patch(q, k, v, extra_options):
-            
-            len_neg, len_pos = self.conditioning_length # negative, positiveの長さ
-            cond_or_uncond = extra_options["cond_or_uncond"] # 0: cond, 1: uncond
-            q_list = q.chunk(len(cond_or_uncond), dim=0)
-            b = q_list[0].shape[0] # batch_size
-            
-            masks_uncond = get_masks_from_q(self.negative_positive_masks[0], q_list[0], extra_options["original_shape"])
-            masks_cond = get_masks_from_q(self.negative_positive_masks[1], q_list[0], extra_options["original_shape"])
+        return (new_model, coupled_output(positive), coupled_output(negative)) # pool outputは・・・後回し
 
-            context_uncond = torch.cat([cond for cond in self.negative_positive_conds[0]], dim=0)
-            context_cond = torch.cat([cond for cond in self.negative_positive_conds[1]], dim=0)
-            
-            k_uncond = module.to_k(context_uncond)
-            k_cond = module.to_k(context_cond)
-            v_uncond = module.to_v(context_uncond)
-            v_cond = module.to_v(context_cond)
+    def get_state(self, positive, negative, dtype, device, attention_mode, region_chunk_size, instrument=False):
+        """CoupleState of the inputs, reused while a patched model prepared from the same tensors is alive"""
+        positive_key, positive_tensors = conditioning_identity(positive)
+        negative_key, negative_tensors = conditioning_identity(negative)
+        tensors = positive_tensors + negative_tensors
+        key = (positive_key, negative_key, dtype, str(device), attention_mode, region_chunk_size, instrument)
+        with prepared_states_lock:
+            state = prepared_states.get(key)
+        if state is not None and state.prepared_from(tensors):
+            return state
 
-            out = []
-            for i, c in enumerate(cond_or_uncond):
-                if c == 0:
-                    masks = masks_cond
-                    k = k_cond
-                    v = v_cond
-                    length = len_pos
-                else:
-                    masks = masks_uncond
-                    k = k_uncond
-                    v = v_uncond
-                    length = len_neg
+        state = self.prepare_state(positive, negative, dtype, device, attention_mode, region_chunk_size, instrument, tensors)
+        with prepared_states_lock:
+            prepared_states[key] = state
+        return state
 
-                q_target = q_list[i].repeat(length, 1, 1)
-                k = torch.cat([k[i].unsqueeze(0).repeat(b,1,1) for i in range(length)], dim=0)
-                v = torch.cat([v[i].unsqueeze(0).repeat(b,1,1) for i in range(length)], dim=0)
+    def prepare_state(self, positive, negative, dtype, device, attention_mode, region_chunk_size, instrument=False, sources=()):
+        """Normalised masks and device copies of the contexts of both sides"""
+        negative_positive_masks = []
+        negative_positive_conds = []
 
-                qkv = optimized_attention(q_target, k, v, extra_options["n_heads"])
-                qkv = qkv * masks
-                qkv = qkv.view(length, b, -1, module.heads * module.dim_head).sum(dim=0)
-
-                out.append(qkv)
+        # maskとcondをリストに格納する
+        for conditions in [negative, positive]:
+            conditions_masks = []
+            conditions_conds = []
+            if len(conditions) != 1:
+                for cond in conditions:
+                    mask = cond[1].get("mask")
+                    if mask is None:
+                        raise ValueError("Attention couple needs a mask on every conditioning entry when there is more than one")
+                    if mask.numel() != mask.shape[-2] * mask.shape[-1]:
+                        raise ValueError(f"Attention couple needs a single mask per conditioning entry, got a mask of shape {list(mask.shape)}. "
+                                         "Per-frame masks such as keyframed RegionConditionMerge output aren't supported")
+                if all(is_region_geometry_current(cond[1]) for cond in conditions):
+                    # Region geometry from RegionConditionMerge, masks are rasterised per attention resolution
+                    conditions_masks = RegionGeometry([cond[1]["region"] for cond in conditions],
+                                                      [cond[1].get("mask_strength", 1.0) for cond in conditions])
+                else:
+                    # Masks from different nodes may be [H, W] or [1, H, W] and of different sizes
+                    masks = [cond[1]["mask"].to(device, dtype=dtype) for cond in conditions]
+                    size = (max(mask.shape[-2] for mask in masks), max(mask.shape[-1] for mask in masks))
+                    masks = [F.interpolate(mask.reshape(1, 1, *mask.shape[-2:]), size=size, mode="nearest")[0, 0] for mask in masks]
+                    mask_norm = torch.stack([mask * cond[1].get("mask_strength", 1.0) for mask, cond in zip(masks, conditions)])
+                    mask_norm = mask_norm / mask_norm.sum(dim=0) # 合計が1になるように正規化(他が0の場合mask_strengthの効果がなくなる)
+                    conditions_masks.extend([mask_norm[i] for i in range(mask_norm.shape[0])])
+                conditions_conds.extend([cond[0].to(device, dtype=dtype) for cond in conditions])
+            else:
+                conditions_masks = [False]
+                conditions_conds = [conditions[0][0].to(device, dtype=dtype)]
+            negative_positive_masks.append(conditions_masks)
+            negative_positive_conds.append(conditions_conds)
+        return CoupleState(negative_positive_masks, negative_positive_conds, (len(negative), len(positive)),
+                           attention_mode, region_chunk_size, PatchStats() if instrument else None, sources)
 
-            out = torch.cat(out, dim=0)
-            return out
-        return patch
-        
 NODE_CLASS_MAPPINGS = {
     "Attention couple": AttentionCouple
 }
@@ -1,8 +1,14 @@
 import os
+import logging
 import cv2
 import numpy as np
 import torch
 from PIL import Image
+from . import memory_budget
+from . import metrics
+from .profiling import profiled
+
+logger = logging.getLogger(__name__)
 
 class CombineVideoClips:
     """
@@ -84,6 +90,7 @@ class CombineVideoClips:
                     "display": "text",
                     "tooltip": "Path to the last video file - can be connected from other nodes"
                 }),
+                **memory_budget.budget_inputs(),
             }
         }
     
@@ -103,12 +110,13 @@ class CombineVideoClips:
         # Let the main processing function handle the validation
         return True
     
-    def load_video_frames(self, video_path, max_frames=None):
-        """Load video frames as numpy arrays"""
+    def load_video_frames(self, video_path, max_frames=None, size=None):
+        """Load video frames as numpy arrays, optionally resized to size (width, height)"""
         if not os.path.exists(video_path):
             raise ValueError(f"Video file not found: {video_path}")
             
-        cap = cv2.VideoCapture(video_path)
+        with metrics.stage(logger, "open", path=video_path):
+            cap = cv2.VideoCapture(video_path)
         
         # Check if video opened successfully
         if not cap.isOpened():
@@ -118,30 +126,35 @@ class CombineVideoClips:
         # Get video properties
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         fps = cap.get(cv2.CAP_PROP_FPS)
-        print(f"[CombineVideo] Video {video_path}: {total_frames} frames, {fps} fps")
+        logger.debug("Video %s: %d frames, %s fps", video_path, total_frames, fps)
         
         frames = []
         frame_count = 0
         
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
+        with metrics.stage(logger, "decode", path=video_path) as record:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                    
+                # Convert BGR to RGB
+                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                if size is not None and (frame_rgb.shape[1], frame_rgb.shape[0]) != size:
+                    frame_rgb = cv2.resize(frame_rgb, size, interpolation=cv2.INTER_AREA)
+                frames.append(frame_rgb)
+                frame_count += 1
                 
-            # Convert BGR to RGB
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frames.append(frame_rgb)
-            frame_count += 1
-            
-            if max_frames and frame_count >= max_frames:
-                break
+                if max_frames and frame_count >= max_frames:
+                    break
+            record["frames"] = frame_count
+            record["bytes"] = metrics.tensor_bytes(*frames)
                 
         cap.release()
         
         if not frames:
             raise ValueError(f"No frames could be loaded from video: {video_path}")
             
-        print(f"[CombineVideo] Successfully loaded {len(frames)} frames from {video_path}")
+        logger.debug("Loaded %d frames from %s", len(frames), video_path)
         return frames
     
     def frames_to_tensor(self, frames_list):
@@ -150,33 +163,53 @@ class CombineVideoClips:
             raise ValueError("Empty frames list provided")
             
         # Convert frames to tensor format (N, H, W, C) normalized to [0, 1]
-        tensor_frames = []
-        for frame in frames_list:
-            # Normalize to [0, 1]
-            normalized_frame = frame.astype(np.float32) / 255.0
-            tensor_frames.append(normalized_frame)
+        with metrics.stage(logger, "convert", frames=len(frames_list)) as record:
+            tensor_frames = []
+            for frame in frames_list:
+                # Normalize to [0, 1]
+                normalized_frame = frame.astype(np.float32) / 255.0
+                tensor_frames.append(normalized_frame)
+            record["bytes"] = metrics.tensor_bytes(*tensor_frames)
         
         # Stack into tensor
-        tensor_output = torch.from_numpy(np.stack(tensor_frames, axis=0))
+        with metrics.stage(logger, "stack", frames=len(tensor_frames)) as record:
+            tensor_output = torch.from_numpy(np.stack(tensor_frames, axis=0))
+            record["bytes"] = metrics.tensor_bytes(tensor_output)
         return tensor_output
     
+    def estimate_combine_bytes(self, frame_load_cap, first_video_path, joined_video_paths, last_video_path):
+        """
+        Estimate peak bytes from container metadata: all loaded uint8 frames plus the float32
+        output, which frames_to_tensor holds twice while stacking. Returns (bytes, first video size).
+        """
+        first_count, width, height = memory_budget.probe_video(first_video_path)
+        last_count, last_width, last_height = memory_budget.probe_video(last_video_path)
+        first_count = min(first_count, frame_load_cap)
+        last_count = min(last_count, frame_load_cap)
+        
+        loaded_bytes = (first_count * memory_budget.frame_bytes(width, height, itemsize=1)
+                        + last_count * memory_budget.frame_bytes(last_width, last_height, itemsize=1))
+        output_frames = min(frame_load_cap // 2, first_count) + max(0, last_count - frame_load_cap // 2)
+        for video_path in joined_video_paths:
+            count, joined_width, joined_height = memory_budget.probe_video(video_path)
+            loaded_bytes += count * memory_budget.frame_bytes(joined_width, joined_height, itemsize=1)
+            output_frames += count
+        
+        output_bytes = output_frames * memory_budget.frame_bytes(width, height)
+        return loaded_bytes + 2 * output_bytes, (width, height)
+    
+    @profiled("combine_videos")
     def combine_videos(self, frame_load_cap, mask_last_frames, mask_first_frames,
                       first_video_path=None, first_joined_video_path=None, second_joined_video_path=None,
                       third_joined_video_path=None, fourth_joined_video_path=None, fifth_joined_video_path=None, 
-                      last_video_path=None):
+                      last_video_path=None, memory_budget_mb=0, on_budget_exceeded="error"):
         """Main processing function that combines the video clips"""
         
-        print(f"[CombineVideo] Starting combine process with parameters:")
-        print(f"  frame_load_cap: {frame_load_cap}")
-        print(f"  mask_last_frames: {mask_last_frames}")
-        print(f"  mask_first_frames: {mask_first_frames}")
-        print(f"  first_video_path: {first_video_path}")
-        print(f"  first_joined_video_path: {first_joined_video_path}")
-        print(f"  second_joined_video_path: {second_joined_video_path}")
-        print(f"  third_joined_video_path: {third_joined_video_path}")
-        print(f"  fourth_joined_video_path: {fourth_joined_video_path}")
-        print(f"  fifth_joined_video_path: {fifth_joined_video_path}")        
-        print(f"  last_video_path: {last_video_path}")
+        logger.debug("Starting combine process: frame_load_cap=%s mask_last_frames=%s mask_first_frames=%s "
+                     "first_video_path=%s joined_video_paths=%s last_video_path=%s",
+                     frame_load_cap, mask_last_frames, mask_first_frames, first_video_path,
+                     [first_joined_video_path, second_joined_video_path, third_joined_video_path,
+                      fourth_joined_video_path, fifth_joined_video_path], last_video_path)
         
         # Handle None values (when inputs are not connected)
         if first_video_path is None:
@@ -213,48 +246,55 @@ class CombineVideoClips:
         if not os.path.exists(last_video_path):
             raise ValueError(f"Last video file not found: {last_video_path}")
         
-        print(f"[CombineVideo] Loading video frames...")
+        # Check the estimated output size against the budget before decoding anything
+        size = None
+        budget_bytes = memory_budget.resolve_budget_bytes(memory_budget_mb)
+        if budget_bytes is not None:
+            joined_video_paths = [p for p in (first_joined_video_path, second_joined_video_path, third_joined_video_path,
+                                              fourth_joined_video_path, fifth_joined_video_path)
+                                  if p and os.path.exists(p)]
+            estimated_bytes, first_size = self.estimate_combine_bytes(frame_load_cap, first_video_path,
+                                                                      joined_video_paths, last_video_path)
+            scale = memory_budget.fit_to_budget(estimated_bytes, budget_bytes, on_budget_exceeded, "CombineVideoClips")
+            if scale < 1.0:
+                # Every clip is resized to the same size so the frames can still be stacked
+                size = memory_budget.scaled_size(first_size[0], first_size[1], scale)
         
         # Load video frames from all provided videos
         try:
             # Load first video (required)
-            first_images_list = self.load_video_frames(first_video_path, frame_load_cap)
+            first_images_list = self.load_video_frames(first_video_path, frame_load_cap, size)
             
             # Load joined videos (optional)
             first_joined_images_list = []
             if first_joined_video_path and os.path.exists(first_joined_video_path):
-                first_joined_images_list = self.load_video_frames(first_joined_video_path)
+                first_joined_images_list = self.load_video_frames(first_joined_video_path, size=size)
                 
             second_joined_images_list = []
             if second_joined_video_path and os.path.exists(second_joined_video_path):
-                second_joined_images_list = self.load_video_frames(second_joined_video_path)
+                second_joined_images_list = self.load_video_frames(second_joined_video_path, size=size)
                 
             third_joined_images_list = []
             if third_joined_video_path and os.path.exists(third_joined_video_path):
-                third_joined_images_list = self.load_video_frames(third_joined_video_path)
+                third_joined_images_list = self.load_video_frames(third_joined_video_path, size=size)
 
             fourth_joined_images_list = []
             if fourth_joined_video_path and os.path.exists(fourth_joined_video_path):
-                fourth_joined_images_list = self.load_video_frames(fourth_joined_video_path)
+                fourth_joined_images_list = self.load_video_frames(fourth_joined_video_path, size=size)
  
             fifth_joined_images_list = []
             if fifth_joined_video_path and os.path.exists(fifth_joined_video_path):
-                fifth_joined_images_list = self.load_video_frames(fifth_joined_video_path)
+                fifth_joined_images_list = self.load_video_frames(fifth_joined_video_path, size=size)
   
             # Load final video (required)
-            final_images_list = self.load_video_frames(last_video_path, frame_load_cap)
+            final_images_list = self.load_video_frames(last_video_path, frame_load_cap, size)
             
-            print(f"[CombineVideo] Loaded frames:")
-            print(f"  First video: {len(first_images_list)} frames")
-            print(f"  First joined: {len(first_joined_images_list)} frames")
-            print(f"  Second joined: {len(second_joined_images_list)} frames")
-            print(f"  Third joined: {len(third_joined_images_list)} frames")
-            print(f"  Fourth joined: {len(fourth_joined_images_list)} frames")
-            print(f"  Fifth joined: {len(fifth_joined_images_list)} frames")            
-            print(f"  Final video: {len(final_images_list)} frames")
+            logger.debug("Loaded frames: first=%d joined=%s final=%d", len(first_images_list),
+                         [len(first_joined_images_list), len(second_joined_images_list), len(third_joined_images_list),
+                          len(fourth_joined_images_list), len(fifth_joined_images_list)], len(final_images_list))
             
         except Exception as e:
-            print(f"[CombineVideo] Error loading video frames: {str(e)}")
+            logger.error("Error loading video frames: %s", e)
             raise ValueError(f"Error loading video frames: {str(e)}")
         
         # 1. Creating output_images_list
@@ -272,34 +312,34 @@ class CombineVideoClips:
         first_images_end_index = min(first_images_end_index, len(first_images_list))
         
         # i: Append images from first_images_list to output_images_list
-        print(f"[CombineVideo] Adding first video frames [{first_images_start_index}:{first_images_end_index}]")
+        logger.debug("Adding first video frames [%d:%d]", first_images_start_index, first_images_end_index)
         for i in range(first_images_start_index, first_images_end_index):
             if i < len(first_images_list):
                 output_images_list.append(first_images_list[i])
         
         # j: If first_joined_images_list is not empty, append all its images
         if first_joined_images_list:
-            print(f"[CombineVideo] Adding first joined video frames: {len(first_joined_images_list)}")
+            logger.debug("Adding first joined video frames: %d", len(first_joined_images_list))
             output_images_list.extend(first_joined_images_list)
         
         # k: If second_joined_images_list is not empty, append all its images
         if second_joined_images_list:
-            print(f"[CombineVideo] Adding second joined video frames: {len(second_joined_images_list)}")
+            logger.debug("Adding second joined video frames: %d", len(second_joined_images_list))
             output_images_list.extend(second_joined_images_list)
         
         # l: If third_joined_images_list is not empty, append all its images
         if third_joined_images_list:
-            print(f"[CombineVideo] Adding third joined video frames: {len(third_joined_images_list)}")
+            logger.debug("Adding third joined video frames: %d", len(third_joined_images_list))
             output_images_list.extend(third_joined_images_list)
         
         # m: If fourth_joined_images_list is not empty, append all its images
         if fourth_joined_images_list:
-            print(f"[CombineVideo] Adding fourth joined video frames: {len(fourth_joined_images_list)}")
+            logger.debug("Adding fourth joined video frames: %d", len(fourth_joined_images_list))
             output_images_list.extend(fourth_joined_images_list)
 
         # n: If fifth_joined_images_list is not empty, append all its images
         if fifth_joined_images_list:
-            print(f"[CombineVideo] Adding fifth joined video frames: {len(fifth_joined_images_list)}")
+            logger.debug("Adding fifth joined video frames: %d", len(fifth_joined_images_list))
             output_images_list.extend(fifth_joined_images_list)
 
         # o: Calculate frame_load_cap // 2 and store in final_images_start_index
@@ -309,7 +349,7 @@ class CombineVideoClips:
         final_images_start_index = min(final_images_start_index, len(final_images_list))
         
         # p: Append images from final_images_list starting from final_images_start_index to end
-        print(f"[CombineVideo] Adding final video frames [{final_images_start_index}:{len(final_images_list)}]")
+        logger.debug("Adding final video frames [%d:%d]", final_images_start_index, len(final_images_list))
         for i in range(final_images_start_index, len(final_images_list)):
             output_images_list.append(final_images_list[i])
         
@@ -317,18 +357,15 @@ class CombineVideoClips:
         if not output_images_list:
             raise ValueError("No output images generated")
         
-        print(f"[CombineVideo] Generated {len(output_images_list)} total output images")
-        
         try:
             image_tensor = self.frames_to_tensor(output_images_list)
             
-            print(f"[CombineVideo] Image tensor shape: {image_tensor.shape}")
-            print(f"[CombineVideo] Video combination completed successfully")
+            logger.info("Combined %d frames into an image tensor of shape %s", len(output_images_list), tuple(image_tensor.shape))
             
             return (image_tensor,)
             
         except Exception as e:
-            print(f"[CombineVideo] Error creating tensor: {str(e)}")
+            logger.error("Error creating tensor: %s", e)
             raise ValueError(f"Error creating output tensor: {str(e)}")
 
 # ComfyUI Node Registration
@@ -0,0 +1,55 @@
+"""Cached content fingerprints for files read by the loader nodes"""
+
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from . import metrics
+
+HASH_CHUNK_SIZE = 1024 * 1024
+FINGERPRINT_CACHE_SIZE = 4096
+
+logger = logging.getLogger(__name__)
+
+# path -> ((mtime_ns, size, inode), digest), least recently used first
+_fingerprints = OrderedDict()
+_fingerprints_lock = threading.Lock()
+
+def _hash_file(path):
+    # SHA-256 is hardware accelerated (SHA-NI, ARMv8 SHA) on current CPUs and outruns BLAKE2b there
+    m = hashlib.sha256()
+    buffer = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            m.update(view[:read])
+    return m.hexdigest()
+
+def file_fingerprint(path):
+    """
+    Hex digest of a file's contents. Digests are cached by (path, mtime, size, inode) and the
+    file is only read again, in chunks, when its stat data changes.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stat_key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    with _fingerprints_lock:
+        cached = _fingerprints.get(path)
+        if cached is not None and cached[0] == stat_key:
+            _fingerprints.move_to_end(path)
+            return cached[1]
+
+    with metrics.stage(logger, "hash", path=path, bytes=stat.st_size):
+        digest = _hash_file(path)
+
+    with _fingerprints_lock:
+        _fingerprints[path] = (stat_key, digest)
+        _fingerprints.move_to_end(path)
+        while len(_fingerprints) > FINGERPRINT_CACHE_SIZE:
+            _fingerprints.popitem(last=False)
+    return digest
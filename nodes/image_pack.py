@@ -0,0 +1,186 @@
+"""
+Packed snapshots of decoded image folders.
+
+A pack holds the uint8 frames and masks of one folder snapshot in a single
+contiguous file so later loads can memory-map it instead of decoding again:
+
+    magic (8 bytes) | header length (uint64 LE) | JSON header | padding | images | masks
+
+The JSON header stores the folder fingerprint (see LoadImageFolder.IS_CHANGED)
+and the shape/offset of each array. Data sections are 64-byte aligned.
+
+Packs are named <folder key>-<variant key>.pack. Only the most recently used
+variants of each folder are kept and the directory is bounded in bytes, the
+least recently used packs are removed first.
+"""
+
+import os
+import json
+import struct
+import hashlib
+import logging
+import numpy as np
+import torch
+import folder_paths
+
+PACK_MAGIC = b"CNPACK01"
+PACK_VERSION = 1
+PACK_ALIGNMENT = 64
+
+# Packs kept per folder, every load option combination (backend, size, frames) is its own variant
+PACK_VARIANTS_PER_FOLDER = 2
+# Total size of the pack directory in MB, overridable with CUSTOMNODES_PACK_MAX_MB
+PACK_MAX_MB_ENV = "CUSTOMNODES_PACK_MAX_MB"
+DEFAULT_PACK_MAX_MB = 8192
+
+logger = logging.getLogger(__name__)
+
+def get_pack_directory():
+    """Directory holding pack files, overridable with CUSTOMNODES_PACK_DIR"""
+    directory = os.environ.get("CUSTOMNODES_PACK_DIR", "").strip()
+    if not directory:
+        directory = os.path.join(folder_paths.get_user_directory(), "image_folder_packs")
+    return directory
+
+def get_pack_path(folder_path, variant=""):
+    """Pack file for a folder; variant separates packs built with different load options"""
+    folder_key = hashlib.sha256(os.path.abspath(folder_path).encode()).hexdigest()[:16]
+    variant_key = hashlib.sha256(variant.encode()).hexdigest()[:16]
+    return os.path.join(get_pack_directory(), f"{folder_key}-{variant_key}.pack")
+
+def get_pack_max_bytes():
+    value = os.environ.get(PACK_MAX_MB_ENV, "").strip()
+    if not value:
+        return DEFAULT_PACK_MAX_MB * 1024 * 1024
+    try:
+        return int(float(value) * 1024 * 1024)
+    except ValueError:
+        raise ValueError(f"{PACK_MAX_MB_ENV} must be a number of megabytes, got: {value}")
+
+def prune_packs(keep_path):
+    """
+    Remove older variants of keep_path's folder beyond PACK_VARIANTS_PER_FOLDER, then the least
+    recently used packs until the directory fits the size limit. keep_path itself is never removed.
+    """
+    directory = os.path.dirname(keep_path)
+    folder_key = os.path.basename(keep_path).split("-", 1)[0]
+    packs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".pack"):
+                    stat = entry.stat()
+                    packs.append((stat.st_mtime_ns, stat.st_size, entry.path, entry.name.split("-", 1)[0]))
+    except OSError:
+        return
+
+    # Most recently used first
+    packs.sort(reverse=True)
+    max_bytes = get_pack_max_bytes()
+    total = 0
+    variants = 0
+    for _, size, path, key in packs:
+        if path != keep_path:
+            if key == folder_key:
+                variants += 1
+            stale = (key == folder_key and variants >= PACK_VARIANTS_PER_FOLDER) or total + size > max_bytes
+            if stale:
+                try:
+                    os.remove(path)
+                    logger.debug("Removed image pack %s", path)
+                except OSError:
+                    pass
+                continue
+        total += size
+
+def _align(offset):
+    return (offset + PACK_ALIGNMENT - 1) // PACK_ALIGNMENT * PACK_ALIGNMENT
+
+def to_uint8(tensor):
+    """Quantize a float tensor in [0, 1] to uint8"""
+    return tensor.clamp(0.0, 1.0).mul(255.0).round_().to(torch.uint8)
+
+def from_uint8(tensor):
+    """Float tensor in [0, 1] from uint8 pack data"""
+    return tensor.to(torch.float32).div_(255.0)
+
+def write_pack(pack_path, fingerprint, images, masks=None):
+    """
+    Write uint8 images [N,H,W,3] and masks [N,H,W] (see to_uint8) to a pack file, masks may be
+    None. Older packs are pruned afterwards.
+    """
+    arrays = {"images": images.contiguous().numpy()}
+    if masks is not None:
+        arrays["masks"] = masks.contiguous().numpy()
+
+    sections = {}
+    offset = 0
+    for name, array in arrays.items():
+        sections[name] = {"shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({
+        "version": PACK_VERSION,
+        "fingerprint": fingerprint,
+        "sections": sections,
+    }).encode()
+    data_start = _align(len(PACK_MAGIC) + 8 + len(header))
+
+    os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+    tmp_path = f"{pack_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(PACK_MAGIC)
+            f.write(struct.pack("<Q", len(header)))
+            f.write(header)
+            for name, array in arrays.items():
+                f.seek(data_start + sections[name]["offset"])
+                f.write(memoryview(array).cast("B"))
+        # Replace atomically so concurrent readers never see a partial pack
+        os.replace(tmp_path, pack_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    prune_packs(pack_path)
+
+def read_pack(pack_path, fingerprint):
+    """
+    Memory-map a pack file and return (images, masks) as uint8 tensors backed by it, masks is
+    None if the pack has none. Returns None if the pack is missing, unreadable or was built from
+    another snapshot.
+    """
+    try:
+        with open(pack_path, "rb") as f:
+            if f.read(len(PACK_MAGIC)) != PACK_MAGIC:
+                return None
+            (header_length,) = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(header_length).decode())
+    except (OSError, ValueError, struct.error):
+        return None
+
+    if header.get("version") != PACK_VERSION or header.get("fingerprint") != fingerprint:
+        return None
+
+    try:
+        # The modification time orders packs by last use for pruning
+        os.utime(pack_path)
+    except OSError:
+        pass
+
+    data_start = _align(len(PACK_MAGIC) + 8 + header_length)
+    tensors = []
+    try:
+        for name in ("images", "masks"):
+            section = header["sections"].get(name)
+            if section is None:
+                tensors.append(None)
+                continue
+            # Copy-on-write mapping gives writable arrays without touching the file
+            array = np.memmap(pack_path, dtype=np.uint8, mode="c",
+                              offset=data_start + section["offset"],
+                              shape=tuple(section["shape"]))
+            tensors.append(torch.from_numpy(array))
+    except (OSError, ValueError, KeyError):
+        return None
+
+    return tuple(tensors)
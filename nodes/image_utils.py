@@ -0,0 +1,197 @@
+"""Image decoding shared by LoadImageFolder and MakeBatchFromSingleImage"""
+
+import logging
+import numpy as np
+import torch
+import cv2
+from PIL import Image, ImageOps
+import node_helpers
+from . import metrics
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif', '.webp']
+
+# "pillow" always decodes through PIL, "opencv" uses cv2.imdecode for images it can decode identically
+IMAGE_DECODE_BACKENDS = ["pillow", "opencv"]
+
+EXIF_ORIENTATION = 0x0112
+# Orientations that rotate by 90 degrees, exif_transpose swaps width and height for them
+EXIF_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+PNG_BIT_DEPTH_OFFSET = 24 # signature (8) + IHDR length/type (8) + width/height (8)
+
+logger = logging.getLogger(__name__)
+
+def exif_orientation(img):
+    """EXIF orientation of a lazily opened PIL image, 1 (upright) when it has none"""
+    # PNG getexif() decodes the whole image when the header has no eXIf chunk, only query it when present
+    if img.format != "JPEG" and "exif" not in img.info:
+        return 1
+    return img.getexif().get(EXIF_ORIENTATION, 1)
+
+def can_decode_with_opencv(img):
+    """Check whether a lazily opened PIL image is a plain single-frame 8-bit RGB/L JPEG or PNG"""
+    if img.format not in ("JPEG", "PNG"):
+        return False
+    if img.mode not in ("RGB", "L"):
+        return False
+    if getattr(img, "n_frames", 1) != 1:
+        return False
+    if "transparency" in img.info:
+        return False
+    if exif_orientation(img) != 1:
+        return False
+    return True
+
+def decode_with_opencv(image_path, img):
+    """Decode with cv2.imdecode, returns an RGB uint8 array or None if OpenCV cannot handle the file"""
+    data = np.fromfile(image_path, dtype=np.uint8)
+    if img.format == "PNG" and (len(data) <= PNG_BIT_DEPTH_OFFSET or data[PNG_BIT_DEPTH_OFFSET] != 8):
+        return None # 16-bit PNGs go through Pillow
+    frame = cv2.imdecode(data, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if frame is None:
+        return None
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+def placeholder_masks(count, height=64, width=64):
+    """Zero masks for frames without alpha, a single zero broadcast to [count, height, width]"""
+    return torch.zeros((), dtype=torch.float32, device="cpu").expand(count, height, width)
+
+def stack_masks(masks, height, width):
+    """
+    Stack per-frame [1,H,W] masks where None marks a frame without alpha.
+    Returns None if no frame has alpha, otherwise opaque frames share one zero tensor before stacking.
+    """
+    if all(mask is None for mask in masks):
+        return None
+    zeros = torch.zeros((1, height, width), dtype=torch.float32, device="cpu")
+    return torch.cat([zeros if mask is None else mask for mask in masks], dim=0)
+
+def frame_selection_inputs():
+    """Optional node inputs selecting frames of animated GIF/WebP/TIFF files"""
+    return {
+        "frame_start": ("INT", {
+            "default": 0,
+            "min": 0,
+            "max": 100000,
+            "step": 1,
+            "display": "number",
+            "tooltip": "First frame to load from animated images, single-frame images are always loaded"
+        }),
+        "frame_stride": ("INT", {
+            "default": 1,
+            "min": 1,
+            "max": 1000,
+            "step": 1,
+            "display": "number",
+            "tooltip": "Load every Nth frame of animated images"
+        }),
+        "max_frames": ("INT", {
+            "default": 0,
+            "min": 0,
+            "max": 100000,
+            "step": 1,
+            "display": "number",
+            "tooltip": "Maximum number of frames to load per animated image, 0 loads all"
+        }),
+    }
+
+def select_frames(frame_count, frame_start=0, frame_stride=1, max_frames=0):
+    """Indices of the frames to load, frame selection only applies to multi-frame images"""
+    if frame_count <= 1:
+        return range(frame_count)
+    indices = range(frame_start, frame_count, max(1, frame_stride))
+    if max_frames > 0:
+        indices = indices[:max_frames]
+    if len(indices) == 0:
+        raise ValueError(f"frame_start {frame_start} is past the last frame ({frame_count} frames)")
+    return indices
+
+def load_image_frames(image_path, backend="pillow", frame_start=0, frame_stride=1, max_frames=0):
+    """
+    Decode the selected frames of an image file into an image [N,H,W,3] float tensor and a
+    mask [N,H,W] tensor, the mask is None when no frame has alpha. Frames whose size differs
+    from the first one are skipped before conversion, MPO files only keep the first frame.
+    """
+    with metrics.stage(logger, "open", path=image_path):
+        img = node_helpers.pillow(Image.open, image_path)
+
+    if backend == "opencv" and can_decode_with_opencv(img):
+        with metrics.stage(logger, "decode", path=image_path, backend="opencv"):
+            frame = decode_with_opencv(image_path, img)
+        if frame is not None:
+            with metrics.stage(logger, "convert", path=image_path) as record:
+                image = torch.from_numpy(frame).to(torch.float32).div_(255.0)[None,]
+                record["bytes"] = metrics.tensor_bytes(image)
+            return (image, None)
+
+    output_images = []
+    output_masks = []
+    w, h = None, None
+    frame_size = None
+
+    excluded_formats = ['MPO']
+
+    frame_indices = select_frames(getattr(img, "n_frames", 1), frame_start, frame_stride, max_frames)
+    if img.format in excluded_formats:
+        frame_indices = frame_indices[:1]
+
+    with metrics.stage(logger, "decode", path=image_path, backend="pillow") as record:
+        for index in frame_indices:
+            # Seek straight to the requested frame instead of converting every frame on the way
+            img.seek(index)
+
+            # Compare the stored frame size before doing any conversion work
+            if frame_size is None:
+                frame_size = img.size
+            elif img.size != frame_size:
+                continue
+
+            i = node_helpers.pillow(ImageOps.exif_transpose, img)
+
+            if i.mode == 'I':
+                i = i.point(lambda i: i * (1 / 255))
+            image = i.convert("RGB")
+
+            if len(output_images) == 0:
+                w = image.size[0]
+                h = image.size[1]
+
+            image = np.array(image).astype(np.float32) / 255.0
+            image = torch.from_numpy(image)[None,]
+
+            if 'A' in i.getbands():
+                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
+                mask = 1. - torch.from_numpy(mask)
+            elif i.mode == 'P' and 'transparency' in i.info:
+                mask = np.array(i.convert('RGBA').getchannel('A')).astype(np.float32) / 255.0
+                mask = 1. - torch.from_numpy(mask)
+            else:
+                # Opaque frame, the mask is only created if another frame has alpha
+                mask = None
+
+            output_images.append(image)
+            output_masks.append(None if mask is None else mask.unsqueeze(0))
+        record["frames"] = len(output_images)
+        record["bytes"] = metrics.tensor_bytes(*output_images)
+
+    if len(output_images) > 1:
+        with metrics.stage(logger, "stack", path=image_path, frames=len(output_images)) as record:
+            output_image = torch.cat(output_images, dim=0)
+            output_mask = stack_masks(output_masks, h, w)
+            record["bytes"] = metrics.tensor_bytes(output_image)
+    else:
+        output_image = output_images[0]
+        output_mask = output_masks[0]
+
+    return (output_image, output_mask)
+
+def read_image_info(image_path):
+    """
+    Read (width, height, frame count) from the image header without decoding pixels. The size is
+    the one after EXIF rotation, like the frames load_image_frames returns.
+    """
+    with Image.open(image_path) as img:
+        frames = 1 if img.format == "MPO" else getattr(img, "n_frames", 1)
+        width, height = img.size
+        if exif_orientation(img) in EXIF_TRANSPOSED_ORIENTATIONS:
+            width, height = height, width
+        return width, height, frames
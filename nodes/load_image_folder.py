@@ -1,11 +1,15 @@
 import os
 import hashlib
-import numpy as np
+import logging
 import torch
-from PIL import Image, ImageOps, ImageSequence
-import folder_paths
-import node_helpers
 import comfy.utils
+from . import image_pack
+from . import image_utils
+from . import memory_budget
+from . import metrics
+from .profiling import profiled
+
+logger = logging.getLogger(__name__)
 
 class LoadImageFolder:
     @classmethod
@@ -18,6 +22,18 @@ class LoadImageFolder:
                     "placeholder": "Enter folder path..."
                 }),
             },
+            "optional": {
+                "use_pack": ("BOOLEAN", {
+                    "default": False,
+                    "tooltip": "Cache the decoded folder in a memory-mapped pack file and reuse it until the folder changes"
+                }),
+                "decode_backend": (image_utils.IMAGE_DECODE_BACKENDS, {
+                    "default": "pillow",
+                    "tooltip": "opencv decodes plain 8-bit JPEG/PNG files faster and falls back to Pillow for everything else"
+                }),
+                **image_utils.frame_selection_inputs(),
+                **memory_budget.budget_inputs(),
+            },
         }
 
     CATEGORY = "image"
@@ -25,7 +41,72 @@ class LoadImageFolder:
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_images_from_folder"
     
-    def load_images_from_folder(self, folder_path):
+    @profiled("load_images_from_folder")
+    def load_images_from_folder(self, folder_path, use_pack=False, decode_backend="pillow",
+                                frame_start=0, frame_stride=1, max_frames=0,
+                                memory_budget_mb=0, on_budget_exceeded="error"):
+        image_files = self.get_image_files(folder_path)
+        frame_selection = {"frame_start": frame_start, "frame_stride": frame_stride, "max_frames": max_frames}
+        
+        # Check the estimated output size against the budget before decoding anything
+        target_size = None
+        budget_bytes = memory_budget.resolve_budget_bytes(memory_budget_mb)
+        if budget_bytes is not None:
+            estimated_bytes, first_size = self.estimate_folder_bytes(folder_path, image_files, frame_selection)
+            scale = memory_budget.fit_to_budget(estimated_bytes, budget_bytes, on_budget_exceeded,
+                                                f"Image folder {folder_path}")
+            if scale < 1.0:
+                target_size = memory_budget.scaled_size(first_size[0], first_size[1], scale)
+        
+        if use_pack:
+            with metrics.stage(logger, "hash", folder=folder_path, files=len(image_files)):
+                fingerprint = self.IS_CHANGED(folder_path)
+            pack_path = image_pack.get_pack_path(
+                folder_path, f"{decode_backend}:{target_size}:{frame_start}:{frame_stride}:{max_frames}")
+            with metrics.stage(logger, "open", folder=folder_path, pack=pack_path) as record:
+                packed = image_pack.read_pack(pack_path, fingerprint)
+                record["hit"] = packed is not None
+            if packed is not None:
+                # The uint8 pack data stays memory-mapped; only the float conversion allocates
+                return self.unpack(folder_path, pack_path, *packed)
+        
+        loaded = self.decode_folder(folder_path, image_files, decode_backend, target_size, frame_selection)
+        
+        if loaded is None:
+            # Return empty tensors if no images loaded, similar to how LoadImage might handle errors
+            empty_image = torch.zeros((1, 64, 64, 3), dtype=torch.float32, device="cpu")
+            empty_mask = torch.zeros((1, 64, 64), dtype=torch.float32, device="cpu")
+            return (empty_image, empty_mask)
+        
+        if use_pack:
+            final_image, final_mask = loaded
+            # Placeholder masks are broadcast views, they are recreated on read instead of stored
+            packed_image = image_pack.to_uint8(final_image)
+            packed_mask = None if final_mask.stride(0) == 0 else image_pack.to_uint8(final_mask)
+            try:
+                with metrics.stage(logger, "pack_write", folder=folder_path, pack=pack_path) as record:
+                    image_pack.write_pack(pack_path, fingerprint, packed_image, packed_mask)
+                    record["bytes"] = packed_image.numel() + (0 if packed_mask is None else packed_mask.numel())
+            except OSError as e:
+                logger.warning("Error writing image pack %s: %s", pack_path, e)
+            # Return the quantised frames a later pack hit returns, so every run gives the same output
+            return self.unpack(folder_path, pack_path, packed_image, packed_mask)
+        
+        return loaded
+    
+    def unpack(self, folder_path, pack_path, packed_image, packed_mask):
+        """Float (image, mask) from uint8 pack data, masks is None for folders without alpha"""
+        with metrics.stage(logger, "convert", folder=folder_path, pack=pack_path) as record:
+            if packed_mask is None:
+                packed_mask = image_utils.placeholder_masks(packed_image.shape[0])
+            else:
+                packed_mask = image_pack.from_uint8(packed_mask)
+            packed_image = image_pack.from_uint8(packed_image)
+            record["bytes"] = metrics.tensor_bytes(packed_image)
+        return (packed_image, packed_mask)
+    
+    def get_image_files(self, folder_path):
+        """Sorted names of the image files in the folder"""
         # Get all files from the folder
         files = []
         for f in os.listdir(folder_path):
@@ -34,12 +115,39 @@ class LoadImageFolder:
                 files.append(f)
         
         # Filter for image files
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif', '.webp']
+        image_extensions = image_utils.IMAGE_EXTENSIONS
         image_files = [f for f in files if f.lower().endswith(tuple(image_extensions))]
         
         # Sort files for consistent ordering
         image_files.sort()
+        return image_files
+    
+    def estimate_folder_bytes(self, folder_path, image_files, frame_selection):
+        """
+        Estimate peak bytes from the image headers: every frame at the first image's size with
+        a full-size mask, held once per image and once in the concatenated output.
+        Returns (bytes, first size).
+        """
+        total_frames = 0
+        first_size = None
+        for image_file in image_files:
+            try:
+                width, height, frames = image_utils.read_image_info(os.path.join(folder_path, image_file))
+                frames = len(image_utils.select_frames(frames, **frame_selection))
+            except Exception:
+                continue
+            if first_size is None:
+                first_size = (width, height)
+            total_frames += frames
+        
+        if first_size is None:
+            return 0, None
         
+        per_frame = memory_budget.frame_bytes(first_size[0], first_size[1], channels=3 + 1)
+        return 2 * total_frames * per_frame, first_size
+    
+    def decode_folder(self, folder_path, image_files, decode_backend="pillow", target_size=None, frame_selection=None):
+        """Decode the given images, returns (image, mask) or None if nothing loaded"""
         all_output_images = []
         all_output_masks = []
         
@@ -47,102 +155,78 @@ class LoadImageFolder:
             image_path = os.path.join(folder_path, image_file)
             
             try:
-                img = node_helpers.pillow(Image.open, image_path)
-                
-                output_images = []
-                output_masks = []
-                w, h = None, None
-                
-                excluded_formats = ['MPO']
+                folder_image, folder_mask = image_utils.load_image_frames(image_path, decode_backend, **(frame_selection or {}))
                 
-                for i in ImageSequence.Iterator(img):
-                    i = node_helpers.pillow(ImageOps.exif_transpose, i)
-                    
-                    if i.mode == 'I':
-                        i = i.point(lambda i: i * (1 / 255))
-                    image = i.convert("RGB")
-                    
-                    if len(output_images) == 0:
-                        w = image.size[0]
-                        h = image.size[1]
-                    
-                    if image.size[0] != w or image.size[1] != h:
-                        continue
-                    
-                    image = np.array(image).astype(np.float32) / 255.0
-                    image = torch.from_numpy(image)[None,]
-                    
-                    if 'A' in i.getbands():
-                        mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                        mask = 1. - torch.from_numpy(mask)
-                    elif i.mode == 'P' and 'transparency' in i.info:
-                        mask = np.array(i.convert('RGBA').getchannel('A')).astype(np.float32) / 255.0
-                        mask = 1. - torch.from_numpy(mask)
-                    else:
-                        mask = torch.zeros((64,64), dtype=torch.float32, device="cpu")
-                    
-                    output_images.append(image)
-                    output_masks.append(mask.unsqueeze(0))
-                
-                if len(output_images) > 1 and img.format not in excluded_formats:
-                    folder_image = torch.cat(output_images, dim=0)
-                    folder_mask = torch.cat(output_masks, dim=0)
-                else:
-                    folder_image = output_images[0]
-                    folder_mask = output_masks[0]
+                if target_size is not None:
+                    # Downscale to the budgeted size
+                    target_width, target_height = target_size
+                    if folder_mask is not None:
+                        folder_mask = comfy.utils.common_upscale(
+                            folder_mask.unsqueeze(1), target_width, target_height, "area", "center"
+                        ).squeeze(1)
+                    folder_image = comfy.utils.common_upscale(
+                        folder_image.movedim(-1, 1), target_width, target_height, "area", "center"
+                    ).movedim(1, -1)
                 
                 all_output_images.append(folder_image)
                 all_output_masks.append(folder_mask)
                 
             except Exception as e:
-                print(f"Error loading image {image_file}: {e}")
+                logger.warning("Error loading image %s: %s", image_file, e)
                 continue
         
         if not all_output_images:
-            # Return empty tensors if no images loaded, similar to how LoadImage might handle errors
-            empty_image = torch.zeros((1, 64, 64, 3), dtype=torch.float32, device="cpu")
-            empty_mask = torch.zeros((1, 64, 64), dtype=torch.float32, device="cpu")
-            return (empty_image, empty_mask)
+            return None
         
-        # Concatenate all images from the folder
-        if len(all_output_images) > 1:
-            # Start with the first image
-            final_image = all_output_images[0]
-            final_mask = all_output_masks[0]
-            
-            # Concatenate the rest, resizing as needed
-            for img, mask in zip(all_output_images[1:], all_output_masks[1:]):
-                # Resize image if dimensions don't match
-                if img.shape[1:] != final_image.shape[1:]:
-                    img = comfy.utils.common_upscale(
+        # Every image is resized to the size of the first one
+        height, width = all_output_images[0].shape[1:3]
+        
+        with metrics.stage(logger, "resize", folder=folder_path) as record:
+            resized = 0
+            for index, img in enumerate(all_output_images):
+                if img.shape[1:3] != (height, width):
+                    all_output_images[index] = comfy.utils.common_upscale(
                         img.movedim(-1, 1), 
-                        final_image.shape[2], 
-                        final_image.shape[1], 
+                        width, 
+                        height, 
                         "lanczos", 
                         "center"
                     ).movedim(1, -1)
-                
-                # Resize mask if dimensions don't match
-                if mask.shape[1:] != final_mask.shape[1:]:
-                    mask = comfy.utils.common_upscale(
-                        mask.unsqueeze(1), 
-                        final_mask.shape[1], 
-                        final_mask.shape[2], 
-                        "lanczos", 
-                        "center"
-                    ).squeeze(1)
-                
-                # Concatenate
-                final_image = torch.cat((final_image, img), dim=0)
-                final_mask = torch.cat((final_mask, mask), dim=0)
-        else:
-            final_image = all_output_images[0]
-            final_mask = all_output_masks[0]
+                    resized += 1
+            record["images"] = resized
+        
+        if all(mask is None for mask in all_output_masks):
+            # No alpha anywhere, all frames share a single placeholder mask
+            frame_count = sum(img.shape[0] for img in all_output_images)
+            with metrics.stage(logger, "stack", folder=folder_path, frames=frame_count) as record:
+                final_image = torch.cat(all_output_images, dim=0)
+                record["bytes"] = metrics.tensor_bytes(final_image)
+            return (final_image, image_utils.placeholder_masks(frame_count))
+        
+        # Only images with alpha have their own masks, opaque ones share one zero frame
+        zeros = torch.zeros((1, height, width), dtype=torch.float32, device="cpu")
+        for index, (img, mask) in enumerate(zip(all_output_images, all_output_masks)):
+            if mask is None:
+                all_output_masks[index] = zeros.expand(img.shape[0], height, width)
+            elif mask.shape[1:] != (height, width):
+                all_output_masks[index] = comfy.utils.common_upscale(
+                    mask.unsqueeze(1), 
+                    width, 
+                    height, 
+                    "lanczos", 
+                    "center"
+                ).squeeze(1)
+        
+        with metrics.stage(logger, "stack", folder=folder_path) as record:
+            final_image = torch.cat(all_output_images, dim=0)
+            final_mask = torch.cat(all_output_masks, dim=0)
+            record["frames"] = final_image.shape[0]
+            record["bytes"] = metrics.tensor_bytes(final_image, final_mask)
         
         return (final_image, final_mask)
 
     @classmethod
-    def IS_CHANGED(s, folder_path):
+    def IS_CHANGED(s, folder_path, **kwargs):
         if not folder_path or not os.path.exists(folder_path):
             return "invalid_path"
         
@@ -152,7 +236,7 @@ class LoadImageFolder:
         m.update(folder_path.encode())
         
         # Get all image files and their modification times
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif', '.webp']
+        image_extensions = image_utils.IMAGE_EXTENSIONS
         image_files = []
         
         try:
@@ -190,7 +274,7 @@ class LoadImageFolder:
             return f"Path is not a directory: {folder_path}"
         
         # Check if folder contains any image files
-        image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tiff', '.tif', '.webp']
+        image_extensions = image_utils.IMAGE_EXTENSIONS
         has_images = False
         
         try:
@@ -1,17 +1,38 @@
 import os
-import hashlib
-import numpy as np
-import torch
-from PIL import Image, ImageOps, ImageSequence
+import threading
 import folder_paths
-import node_helpers
+from . import image_utils
+from .fingerprint import file_fingerprint
+
+# input directory -> (directory mtime_ns, sorted image files)
+input_listing_cache = {}
+input_listing_lock = threading.Lock()
+
+def list_input_images():
+    """
+    Sorted image files of the input directory. The listing is cached and only rebuilt when the
+    directory's mtime changes, which happens whenever an entry is added, removed or renamed.
+    """
+    input_dir = folder_paths.get_input_directory()
+    mtime = os.stat(input_dir).st_mtime_ns
+
+    with input_listing_lock:
+        cached = input_listing_cache.get(input_dir)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    with os.scandir(input_dir) as entries:
+        files = [entry.name for entry in entries if entry.is_file()]
+    files = sorted(folder_paths.filter_files_content_types(files, ["image"]))
+
+    with input_listing_lock:
+        input_listing_cache[input_dir] = (mtime, files)
+    return files
 
 class MakeBatchFromSingleImage:
     @classmethod
     def INPUT_TYPES(s):
-        input_dir = folder_paths.get_input_directory()
-        files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
-        files = folder_paths.filter_files_content_types(files, ["image"])
+        files = list_input_images()
         return {"required":
                     {"batch_count": ("INT", {
                         "default": 1, 
@@ -20,7 +41,17 @@ class MakeBatchFromSingleImage:
                         "step": 1,
                         "display": "number"
                     }),
-                     "image": (sorted(files), {"image_upload": True})},
+                     "image": (list(files), {"image_upload": True})},
+                "optional":
+                    {"decode_backend": (image_utils.IMAGE_DECODE_BACKENDS, {
+                        "default": "pillow",
+                        "tooltip": "opencv decodes plain 8-bit JPEG/PNG files faster and falls back to Pillow for everything else"
+                    }),
+                     "materialize": ("BOOLEAN", {
+                        "default": True,
+                        "tooltip": "Copy the image into every batch entry. Disable to return a zero-copy expanded view of single-frame images, only keep it enabled if a downstream node needs contiguous storage"
+                    }),
+                     **image_utils.frame_selection_inputs()},
                 }
 
     CATEGORY = "image"
@@ -28,79 +59,36 @@ class MakeBatchFromSingleImage:
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "make_batch_from_single_image"
     
-    def make_batch_from_single_image(self, batch_count, image):
+    def make_batch_from_single_image(self, batch_count, image, decode_backend="pillow", materialize=True,
+                                     frame_start=0, frame_stride=1, max_frames=0):
         image_path = folder_paths.get_annotated_filepath(image)
 
-        img = node_helpers.pillow(Image.open, image_path)
-
-        output_images = []
-        output_masks = []
-        w, h = None, None
-
-        excluded_formats = ['MPO']
-
-        for i in ImageSequence.Iterator(img):
-            i = node_helpers.pillow(ImageOps.exif_transpose, i)
-
-            if i.mode == 'I':
-                i = i.point(lambda i: i * (1 / 255))
-            image = i.convert("RGB")
-
-            if len(output_images) == 0:
-                w = image.size[0]
-                h = image.size[1]
-
-            if image.size[0] != w or image.size[1] != h:
-                continue
-
-            image = np.array(image).astype(np.float32) / 255.0
-            image = torch.from_numpy(image)[None,]
-            
-            if 'A' in i.getbands():
-                mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
-                mask = 1. - torch.from_numpy(mask)
-            elif i.mode == 'P' and 'transparency' in i.info:
-                mask = np.array(i.convert('RGBA').getchannel('A')).astype(np.float32) / 255.0
-                mask = 1. - torch.from_numpy(mask)
-            else:
-                mask = torch.zeros((64,64), dtype=torch.float32, device="cpu")
-            output_images.append(image)
-            output_masks.append(mask.unsqueeze(0))
-
-        if len(output_images) > 1 and img.format not in excluded_formats:
-            output_image = torch.cat(output_images, dim=0)
-            output_mask = torch.cat(output_masks, dim=0)
-        else:
-            output_image = output_images[0]
-            output_mask = output_masks[0]
+        output_image, output_mask = image_utils.load_image_frames(image_path, decode_backend,
+                                                                  frame_start, frame_stride, max_frames)
+        if output_mask is None:
+            output_mask = image_utils.placeholder_masks(output_image.shape[0])
 
-        # Create batch by repeating the image batch_count times
-        batch_images = []
-        batch_masks = []
-        
-        for _ in range(batch_count):
-            batch_images.append(output_image)
-            batch_masks.append(output_mask)
-        
-        # Concatenate to create the final batch
-        if batch_count > 1:
-            batched_image = torch.cat(batch_images, dim=0)
-            batched_mask = torch.cat(batch_masks, dim=0)
-        else:
+        if batch_count == 1:
             batched_image = output_image
-            batched_mask = output_mask
+            # The placeholder mask is a stride-0 view, materialize gives it its own storage
+            batched_mask = output_mask.contiguous() if materialize else output_mask
+        elif not materialize and output_image.shape[0] == 1:
+            # Every batch entry is a view of the same frame, O(1) in time and memory
+            batched_image = output_image.expand(batch_count, -1, -1, -1)
+            batched_mask = output_mask.expand(batch_count, -1, -1)
+        else:
+            # Animated images can't be tiled as a view, repeat copies them in a single allocation
+            batched_image = output_image.repeat(batch_count, 1, 1, 1)
+            batched_mask = output_mask.repeat(batch_count, 1, 1)
 
         return (batched_image, batched_mask)
 
     @classmethod
-    def IS_CHANGED(s, batch_count, image):
+    def IS_CHANGED(s, batch_count, image, **kwargs):
         image_path = folder_paths.get_annotated_filepath(image)
-        m = hashlib.sha256()
-        with open(image_path, 'rb') as f:
-            m.update(f.read())
-        # Include batch_count in the hash so the node re-executes when batch count changes
-        m.update(str(batch_count).encode())
-        return m.digest().hex()
+        # Content hash is cached until the file's stat data changes
+        # Include batch_count so the node re-executes when batch count changes
+        return f"{file_fingerprint(image_path)}-{batch_count}"
 
     @classmethod
     def VALIDATE_INPUTS(s, batch_count, image):
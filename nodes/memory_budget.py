@@ -0,0 +1,88 @@
+"""Output size estimation and memory budget checks for the loader nodes"""
+
+import os
+import math
+import logging
+import cv2
+
+MEMORY_BUDGET_ENV = "CUSTOMNODES_MEMORY_BUDGET_MB"
+
+# "error" refuses to load, "downscale" reduces the resolution until the estimate fits
+BUDGET_ACTIONS = ["error", "downscale"]
+
+FLOAT32_BYTES = 4
+
+logger = logging.getLogger(__name__)
+
+def budget_inputs():
+    """Optional node inputs shared by every node that honours the memory budget"""
+    return {
+        "memory_budget_mb": ("INT", {
+            "default": 0,
+            "min": 0,
+            "max": 1048576,
+            "step": 256,
+            "display": "number",
+            "tooltip": f"Maximum estimated memory for the output in MB, 0 uses {MEMORY_BUDGET_ENV} (unlimited if unset)"
+        }),
+        "on_budget_exceeded": (BUDGET_ACTIONS, {
+            "default": "error",
+            "tooltip": "Fail with an error or reduce the resolution when the estimate exceeds the budget"
+        }),
+    }
+
+def resolve_budget_bytes(memory_budget_mb=0):
+    """Budget in bytes from the node input or the environment default, None if unlimited"""
+    if not memory_budget_mb:
+        value = os.environ.get(MEMORY_BUDGET_ENV, "").strip()
+        if not value:
+            return None
+        try:
+            memory_budget_mb = float(value)
+        except ValueError:
+            raise ValueError(f"{MEMORY_BUDGET_ENV} must be a number of megabytes, got: {value}")
+    if memory_budget_mb <= 0:
+        return None
+    return int(memory_budget_mb * 1024 * 1024)
+
+def format_bytes(num_bytes):
+    return f"{num_bytes / (1024 * 1024):.1f} MB"
+
+def fit_to_budget(estimated_bytes, budget_bytes, action, what):
+    """
+    Return the linear resolution scale (<= 1.0) that brings the estimate within budget.
+    Memory is assumed to grow with pixel area. Raises ValueError when action is "error".
+    """
+    if budget_bytes is None or estimated_bytes <= budget_bytes:
+        return 1.0
+    if action != "downscale":
+        raise ValueError(
+            f"{what} needs an estimated {format_bytes(estimated_bytes)}, which exceeds the memory budget "
+            f"of {format_bytes(budget_bytes)}. Load fewer frames, raise memory_budget_mb or set "
+            f"on_budget_exceeded to downscale."
+        )
+    scale = math.sqrt(budget_bytes / estimated_bytes)
+    logger.warning("%s: estimated %s exceeds %s, downscaling by %.3f",
+                   what, format_bytes(estimated_bytes), format_bytes(budget_bytes), scale)
+    return scale
+
+def scaled_size(width, height, scale):
+    """(width, height) after applying a resolution scale, never below 1 pixel"""
+    if scale >= 1.0:
+        return width, height
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+def probe_video(video_path):
+    """Read (frame count, width, height) from the container metadata without decoding frames"""
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            raise ValueError(f"Could not open video file: {video_path}")
+        return (int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    finally:
+        cap.release()
+
+def frame_bytes(width, height, channels=3, itemsize=FLOAT32_BYTES):
+    return width * height * channels * itemsize
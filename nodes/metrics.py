@@ -0,0 +1,66 @@
+"""Package logging configuration and per-stage timing metrics"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+# Level of the package logger, e.g. DEBUG to log every stage timing
+LOG_LEVEL_ENV = "CUSTOMNODES_LOG_LEVEL"
+# Optional JSON lines file every timed stage is appended to
+METRICS_FILE_ENV = "CUSTOMNODES_METRICS_FILE"
+
+metrics_file_lock = threading.Lock()
+
+def configure_logging(logger):
+    """Set the package logger level from the environment, records still go to ComfyUI's handlers"""
+    level = os.environ.get(LOG_LEVEL_ENV, "").strip().upper()
+    if not level:
+        return
+    try:
+        logger.setLevel(level)
+    except ValueError:
+        logger.warning("Ignoring invalid %s: %s", LOG_LEVEL_ENV, level)
+
+def tensor_bytes(*tensors):
+    """Storage size of the given tensors or numpy arrays"""
+    total = 0
+    for t in tensors:
+        if hasattr(t, "nbytes"):
+            total += t.nbytes
+        else:
+            total += t.numel() * t.element_size()
+    return total
+
+def write_metric(record):
+    """Append a record to the metrics file, no-op when METRICS_FILE_ENV is unset"""
+    metrics_file = os.environ.get(METRICS_FILE_ENV, "").strip()
+    if not metrics_file:
+        return
+    line = json.dumps(record, default=str) + "\n"
+    with metrics_file_lock:
+        with open(metrics_file, "a", encoding="utf-8") as f:
+            f.write(line)
+
+@contextmanager
+def stage(logger, name, **fields):
+    """
+    Time a processing stage (open, decode, convert, stack, resize, hash, ...). The yielded dict
+    takes a "bytes" count and any other fields, the stage is logged at DEBUG level and written to
+    the metrics file with its duration_ms.
+    """
+    record = {"stage": name, **fields}
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["duration_ms"] = round((time.perf_counter() - start) * 1000, 3)
+        if logger.isEnabledFor(logging.DEBUG):
+            details = " ".join(f"{key}={value}" for key, value in record.items() if key not in ("stage", "duration_ms"))
+            logger.debug("stage=%s duration_ms=%.2f %s", name, record["duration_ms"], details)
+        write_metric({"time": time.time(), "logger": logger.name, **record})
@@ -0,0 +1,108 @@
+"""
+Opt-in profiler capture around node functions.
+
+CUSTOMNODES_PROFILE selects the profilers as a comma separated list of "cprofile" and/or
+"torch" (CPU activity). Traces are written to CUSTOMNODES_PROFILE_DIR, and only every
+Nth execution of each node function is captured with CUSTOMNODES_PROFILE_EVERY=N.
+"""
+
+import os
+import time
+import cProfile
+import logging
+import threading
+import functools
+import folder_paths
+
+PROFILE_ENV = "CUSTOMNODES_PROFILE"
+PROFILE_DIR_ENV = "CUSTOMNODES_PROFILE_DIR"
+PROFILE_EVERY_ENV = "CUSTOMNODES_PROFILE_EVERY"
+
+PROFILERS = ("cprofile", "torch")
+
+logger = logging.getLogger(__name__)
+
+# function name -> number of executions, used to sample every Nth call
+call_counts = {}
+call_counts_lock = threading.Lock()
+
+def get_profile_directory():
+    """Directory the traces are written to, overridable with CUSTOMNODES_PROFILE_DIR"""
+    directory = os.environ.get(PROFILE_DIR_ENV, "").strip()
+    if not directory:
+        directory = os.path.join(folder_paths.get_user_directory(), "profiles")
+    return directory
+
+def enabled_profilers():
+    """Profilers requested in the environment, empty when profiling is off"""
+    names = [name.strip().lower() for name in os.environ.get(PROFILE_ENV, "").split(",") if name.strip()]
+    if "both" in names or "all" in names:
+        return list(PROFILERS)
+    unknown = [name for name in names if name not in PROFILERS]
+    if unknown:
+        logger.warning("Ignoring unknown profilers in %s: %s", PROFILE_ENV, ", ".join(unknown))
+    return [name for name in PROFILERS if name in names]
+
+def profile_every():
+    value = os.environ.get(PROFILE_EVERY_ENV, "").strip()
+    if not value:
+        return 1
+    try:
+        return max(1, int(value))
+    except ValueError:
+        raise ValueError(f"{PROFILE_EVERY_ENV} must be a whole number, got: {value}")
+
+def should_profile(name):
+    """Count an execution of name and decide whether it is sampled"""
+    with call_counts_lock:
+        count = call_counts.get(name, 0) + 1
+        call_counts[name] = count
+    return (count - 1) % profile_every() == 0, count
+
+def profiled(name):
+    """
+    Decorator capturing the configured profilers around a node function. Without
+    CUSTOMNODES_PROFILE the function is called directly.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profilers = enabled_profilers()
+            if not profilers:
+                return func(*args, **kwargs)
+            sampled, count = should_profile(name)
+            if not sampled:
+                return func(*args, **kwargs)
+            return run_profiled(name, count, profilers, func, args, kwargs)
+        return wrapper
+    return decorator
+
+def run_profiled(name, count, profilers, func, args, kwargs):
+    directory = get_profile_directory()
+    os.makedirs(directory, exist_ok=True)
+    base_path = os.path.join(directory, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}-{count}")
+
+    torch_profiler = None
+    if "torch" in profilers:
+        import torch.profiler
+        torch_profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                record_shapes=True, profile_memory=True)
+    c_profiler = cProfile.Profile() if "cprofile" in profilers else None
+
+    if torch_profiler is not None:
+        torch_profiler.__enter__()
+    if c_profiler is not None:
+        c_profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        written = []
+        if c_profiler is not None:
+            c_profiler.disable()
+            c_profiler.dump_stats(base_path + ".prof")
+            written.append(base_path + ".prof")
+        if torch_profiler is not None:
+            torch_profiler.__exit__(None, None, None)
+            torch_profiler.export_chrome_trace(base_path + ".trace.json")
+            written.append(base_path + ".trace.json")
+        logger.info("Profiled %s (execution %d): %s", name, count, ", ".join(written))
@@ -1,5 +1,122 @@
+import threading
+from collections import OrderedDict
 import torch
 import torch.nn.functional as F
+from .profiling import profiled
+
+# Spatial downscale between pixel space and latent space (SD1.x, SDXL, Wan)
+LATENT_SCALE = 8
+
+# "latent" rasterises region masks at latent resolution, "full" at the canvas resolution
+MASK_RESOLUTIONS = ["latent", "full"]
+
+def rasterize_rects(rects, strengths, canvas, height, width, feather=0.0):
+    """
+    Rasterise rectangles into height x width masks in one vectorised pass.
+    rects [..., 4] are (x0, y0, x1, y1) in canvas pixels, strengths [...] and canvas [..., 2]
+    (canvas width, height) broadcast against them. Returns [..., height, width] float32 masks.
+
+    Hard edges (feather == 0) round up like nearest-neighbour downsampling of the full-resolution
+    mask does, so masks at any resolution match downsampling one at canvas resolution.
+    feather > 0 ramps each edge linearly over that many canvas pixels.
+    """
+    rects = rects.to(torch.float64)
+    canvas = canvas.to(torch.float64)
+    canvas_width = canvas[..., 0:1]
+    canvas_height = canvas[..., 1:2]
+    xs = torch.arange(width, dtype=torch.float64)
+    ys = torch.arange(height, dtype=torch.float64)
+
+    if feather <= 0:
+        x0 = torch.ceil(rects[..., 0:1] * width / canvas_width)
+        x1 = torch.ceil(rects[..., 2:3] * width / canvas_width)
+        y0 = torch.ceil(rects[..., 1:2] * height / canvas_height)
+        y1 = torch.ceil(rects[..., 3:4] * height / canvas_height)
+        weight_x = (xs >= x0) & (xs < x1)
+        weight_y = (ys >= y0) & (ys < y1)
+    else:
+        # Signed distance from each pixel centre to the nearest edge, in canvas pixels
+        centre_x = (xs + 0.5) * canvas_width / width
+        centre_y = (ys + 0.5) * canvas_height / height
+        inside_x = torch.minimum(centre_x - rects[..., 0:1], rects[..., 2:3] - centre_x)
+        inside_y = torch.minimum(centre_y - rects[..., 1:2], rects[..., 3:4] - centre_y)
+        weight_x = (inside_x / feather + 0.5).clamp(0.0, 1.0)
+        weight_y = (inside_y / feather + 0.5).clamp(0.0, 1.0)
+        empty = (rects[..., 2] <= rects[..., 0]) | (rects[..., 3] <= rects[..., 1])
+        strengths = strengths.masked_fill(empty, 0.0)
+
+    weight_x = weight_x.to(torch.float32)
+    weight_y = weight_y.to(torch.float32) * strengths.to(torch.float32).unsqueeze(-1)
+    # Outer product of the per-row and per-column weights
+    return weight_y.unsqueeze(-1) * weight_x.unsqueeze(-2)
+
+def normalize_overlaps(masks, dim=0):
+    """Scale overlapping masks so their per-pixel sum never exceeds 1"""
+    return masks / masks.sum(dim=dim, keepdim=True).clamp(min=1.0)
+
+def rasterize_regions(regions, height, width, feather=0.0, normalize=False):
+    """Rasterise region rectangles (see RegionConditionMerge.get_region) into one [N, height, width] tensor"""
+    rects = torch.tensor([[r['x'], r['y'], r['x'] + r['w'], r['y'] + r['h']] for r in regions], dtype=torch.float64)
+    canvas = torch.tensor([r['canvas'] for r in regions], dtype=torch.float64)
+    strengths = torch.tensor([float(r['strength']) for r in regions], dtype=torch.float32)
+    masks = rasterize_rects(rects, strengths, canvas, height, width, feather)
+    if normalize:
+        masks = normalize_overlaps(masks)
+    return masks
+
+def interpolate_keyframes(keyframes, frame_count):
+    """
+    Linearly interpolate keyframe rows (frame, values...) to [frame_count, values] for every
+    frame at once. Values are held before the first and after the last keyframe.
+    """
+    keyframes = torch.tensor(keyframes, dtype=torch.float64)
+    times, values = keyframes[:, 0].contiguous(), keyframes[:, 1:]
+    if len(times) == 1:
+        return values.expand(frame_count, -1)
+    frames = torch.arange(frame_count, dtype=torch.float64)
+    upper = torch.searchsorted(times, frames, right=True).clamp(1, len(times) - 1)
+    t0, t1 = times[upper - 1], times[upper]
+    alpha = ((frames - t0) / (t1 - t0)).clamp(0.0, 1.0).unsqueeze(-1)
+    return values[upper - 1] + (values[upper] - values[upper - 1]) * alpha
+
+# LRU of rasterised region masks shared across prompts, bounded by the bytes of the masks
+REGION_MASK_CACHE_BYTES = 64 * 1024 * 1024
+region_mask_cache = OrderedDict()
+region_mask_cache_bytes = 0
+region_mask_cache_lock = threading.Lock()
+
+def cached_region_masks(regions, height, width, feather=0.0):
+    """
+    Masks for each region, memoised on (canvas size, mask size, x, y, w, h, strength, feather).
+    Regions missing from the cache are rasterised together in one pass. Cached masks are shared
+    between runs and must not be modified in place.
+    """
+    global region_mask_cache_bytes
+    keys = [(tuple(r['canvas']), height, width, r['x'], r['y'], r['w'], r['h'], float(r['strength']), feather)
+            for r in regions]
+
+    with region_mask_cache_lock:
+        masks = [region_mask_cache.get(key) for key in keys]
+        for key, mask in zip(keys, masks):
+            if mask is not None:
+                region_mask_cache.move_to_end(key)
+
+    missing = [index for index, mask in enumerate(masks) if mask is None]
+    if missing:
+        fresh = rasterize_regions([regions[index] for index in missing], height, width, feather)
+        with region_mask_cache_lock:
+            for index, mask in zip(missing, fresh):
+                # A clone owns only its own storage, a view would pin the whole stacked batch
+                mask = mask.clone()
+                masks[index] = mask
+                if mask.nbytes > REGION_MASK_CACHE_BYTES or keys[index] in region_mask_cache:
+                    continue
+                region_mask_cache[keys[index]] = mask
+                region_mask_cache_bytes += mask.nbytes
+            while region_mask_cache_bytes > REGION_MASK_CACHE_BYTES:
+                _, evicted = region_mask_cache.popitem(last=False)
+                region_mask_cache_bytes -= evicted.nbytes
+    return masks
 
 class RegionConditionSpecPct:
     """
@@ -55,6 +172,54 @@ class RegionConditionSpecPx:
             'strength': strength
         },)
 
+class RegionConditionSpecKeyframes:
+    """
+    Define a region that moves over time with keyframes, one per line:
+    "frame: x, y, width, height[, strength]". Values in between are interpolated linearly.
+    """
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {"required":{
+            'conditioning': ("CONDITIONING",),
+            'units': (["pct", "px"], {"tooltip": "Keyframe values in percent of the canvas or in pixels"}),
+            'frame_count': ("INT", {"default": 81, "min": 1, "max": 10000}),
+            'keyframes': ("STRING", {"multiline": True, "default": "0: 0, 0, 50, 100\n80: 50, 0, 50, 100"}),
+            'strength': ("FLOAT", {"default": 1.0, "min": 0.0, "max": 10.0, "step": 0.01, "tooltip": "Strength for keyframes that don't set one"})
+        }}
+    RETURN_TYPES = ("REGION_SPEC",)
+    FUNCTION = "make_spec_keyframes"
+    CATEGORY = "Region Conditioning"
+
+    def parse_keyframes(self, keyframes, units, strength):
+        """Parse keyframe lines into sorted (frame, x, y, w, h, strength) rows, later lines win on duplicate frames"""
+        scale = 1.0 / 100.0 if units == 'pct' else 1.0
+        rows = {}
+        for line_number, line in enumerate(keyframes.splitlines(), start=1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                frame, values = line.split(':', 1)
+                values = [float(v) for v in values.split(',')]
+                if len(values) not in (4, 5):
+                    raise ValueError
+                frame = int(frame)
+            except ValueError:
+                raise ValueError(f"Invalid keyframe on line {line_number}: '{line}', expected 'frame: x, y, width, height[, strength]'")
+            x, y, w, h = (v * scale for v in values[:4])
+            rows[frame] = (frame, x, y, w, h, values[4] if len(values) == 5 else strength)
+        if not rows:
+            raise ValueError("At least one keyframe is required")
+        return [rows[frame] for frame in sorted(rows)]
+
+    def make_spec_keyframes(self, conditioning, units, frame_count, keyframes, strength):
+        return ({
+            'conditioning': conditioning,
+            'mode': units,
+            'frames': frame_count,
+            'keyframes': self.parse_keyframes(keyframes, units, strength),
+        },)
+
 class RegionConditionMerge:
     """
     Merge multiple region specs, apply masks, and combine conditionings.
@@ -66,21 +231,45 @@ class RegionConditionMerge:
                 'width': ("INT", {"default": 512, "min": 64, "max": 8192}),
                 'height': ("INT", {"default": 512, "min": 64, "max": 8192})
             },
-            "optional": {},
+            "optional": {
+                'mask_resolution': (MASK_RESOLUTIONS, {"default": "latent", "tooltip": "Rasterise masks at latent resolution (1/8), or at full canvas resolution for nodes that need it"}),
+                'feather': ("INT", {"default": 0, "min": 0, "max": 1024, "step": 1, "tooltip": "Soften region edges over this many canvas pixels"}),
+                'normalize_overlap': ("BOOLEAN", {"default": False, "tooltip": "Scale overlapping regions so their combined strength never exceeds 1"}),
+            },
         }
     RETURN_TYPES = ("CONDITIONING",)
     FUNCTION = "merge_regions"
     CATEGORY = "Region Conditioning"
 
-    def set_mask(self, conditioning, mask):
-        """Apply mask to conditioning using ComfyUI's standard approach"""
-        c = []
-        for t in conditioning:
-            n = [t[0], t[1].copy()]
-            n[1]['mask'] = mask
-            n[1]['set_area_to_bounds'] = False
-            c.append(n)
-        return c
+    def set_mask(self, conditioning, mask, region=None):
+        """
+        Apply mask to conditioning using ComfyUI's standard approach. Only the metadata dict is
+        copied, the embedding and pooled output tensors are shared with the input conditioning.
+        """
+        extra = {'mask': mask, 'set_area_to_bounds': False}
+        if region is not None:
+            # Rectangle geometry so consumers can rasterise at the resolution they need. It holds
+            # the mask it describes, a node replacing the mask downstream invalidates the geometry
+            extra['region'] = {**region, 'mask': mask}
+        return [[t[0], {**t[1], **extra}] for t in conditioning]
+
+    def get_region(self, spec, width, height, feather=0):
+        """Resolve a region spec to a rectangle in canvas pixels"""
+        if spec.get('mode') == 'pct':
+            x0 = int(spec['x'] * width)
+            y0 = int(spec['y'] * height)
+            w0 = int(spec['w'] * width)
+            h0 = int(spec['h'] * height)
+        else:
+            x0, y0, w0, h0 = spec['x'], spec['y'], spec['w'], spec['h']
+            w0 = max(0, min(w0, width - x0))
+            h0 = max(0, min(h0, height - y0))
+        return {
+            'x': x0, 'y': y0, 'w': w0, 'h': h0,
+            'canvas': (width, height),
+            'strength': spec['strength'],
+            'feather': feather,
+        }
 
     def combine_conditioning(self, conditioning_list):
         """Combine multiple conditionings using ComfyUI's standard approach"""
@@ -96,48 +285,81 @@ class RegionConditionMerge:
                 combined.append(cond_set)
         return combined
 
-    def merge_regions(self, width, height, **kwargs):
+    @profiled("merge_regions")
+    def merge_regions(self, width, height, mask_resolution="latent", feather=0, normalize_overlap=False, **kwargs):
         # Filter out None values and collect region specs
-        specs = [v for v in kwargs.values() if v is not None]
+        specs = [v for k, v in kwargs.items() if k.startswith("region_spec") and v is not None]
         
         if not specs:
             # Return empty conditioning if no specs provided
             return ([],)
         
+        if mask_resolution == "full":
+            mask_height, mask_width = height, width
+        else:
+            mask_height, mask_width = max(1, height // LATENT_SCALE), max(1, width // LATENT_SCALE)
+        
+        if any('keyframes' in spec for spec in specs):
+            result = self.merge_keyframed_regions(specs, width, height, mask_height, mask_width, feather, normalize_overlap)
+            return (result,)
+        
+        # Masks seen before are reused, new ones are built together in one vectorised pass
+        regions = [self.get_region(spec, width, height, feather) for spec in specs]
+        masks = cached_region_masks(regions, mask_height, mask_width, feather)
+        if normalize_overlap:
+            masks = normalize_overlaps(torch.stack(masks))
+        
         masked = []
-        for spec in specs:
-            cond = spec['conditioning']
-            if spec.get('mode') == 'pct':
-                x0 = int(spec['x'] * width)
-                y0 = int(spec['y'] * height)
-                w0 = int(spec['w'] * width)
-                h0 = int(spec['h'] * height)
-            else:
-                x0, y0, w0, h0 = spec['x'], spec['y'], spec['w'], spec['h']
-                w0 = max(0, min(w0, width - x0))
-                h0 = max(0, min(h0, height - y0))
-            
-            # Create mask tensor
-            mask = torch.zeros((height, width), dtype=torch.float32)
-            if w0 > 0 and h0 > 0:
-                mask[y0:y0+h0, x0:x0+w0] = spec['strength']
-            
+        for spec, region, mask in zip(specs, regions, masks):
             # Apply mask to conditioning
-            masked_cond = self.set_mask(cond, mask)
+            masked_cond = self.set_mask(spec['conditioning'], mask, region)
             masked.append(masked_cond)
         
         # Combine all masked conditionings
         result = self.combine_conditioning(masked)
         return (result,)
 
+    def merge_keyframed_regions(self, specs, width, height, mask_height, mask_width, feather, normalize_overlap):
+        """Give every region a [frames, H, W] mask, all regions and frames rasterised in one pass"""
+        frame_count = max(spec.get('frames', 1) for spec in specs)
+        
+        rects = []
+        strengths = []
+        for spec in specs:
+            if 'keyframes' in spec:
+                x, y, w, h, strength = interpolate_keyframes(spec['keyframes'], frame_count).unbind(-1)
+                if spec['mode'] == 'pct':
+                    # Truncated to whole pixels like get_region does for static regions
+                    x, y, w, h = (torch.trunc(v * size) for v, size in ((x, width), (y, height), (w, width), (h, height)))
+                else:
+                    w = torch.minimum(w, width - x).clamp(min=0)
+                    h = torch.minimum(h, height - y).clamp(min=0)
+            else:
+                # Static regions are broadcast over every frame
+                region = self.get_region(spec, width, height)
+                x, y, w, h, strength = (torch.full((frame_count,), float(region[k]), dtype=torch.float64)
+                                        for k in ('x', 'y', 'w', 'h', 'strength'))
+            rects.append(torch.stack([x, y, x + w, y + h], dim=-1))
+            strengths.append(strength)
+        
+        canvas = torch.tensor([width, height], dtype=torch.float64)
+        masks = rasterize_rects(torch.stack(rects), torch.stack(strengths), canvas, mask_height, mask_width, feather)
+        if normalize_overlap:
+            masks = normalize_overlaps(masks)
+        
+        masked = [self.set_mask(spec['conditioning'], mask) for spec, mask in zip(specs, masks)]
+        return self.combine_conditioning(masked)
+
 NODE_CLASS_MAPPINGS = {
     "RegionConditionSpecPct": RegionConditionSpecPct,
     "RegionConditionSpecPx": RegionConditionSpecPx,
+    "RegionConditionSpecKeyframes": RegionConditionSpecKeyframes,
     "RegionConditionMerge": RegionConditionMerge,
 }
 
 NODE_DISPLAY_NAME_MAPPINGS = {
     "RegionConditionSpecPct": "Region Condition Spec (Percentage)",
     "RegionConditionSpecPx": "Region Condition Spec (Pixels)",
+    "RegionConditionSpecKeyframes": "Region Condition Spec (Keyframes)",
     "RegionConditionMerge": "Region Condition Merge",
 }
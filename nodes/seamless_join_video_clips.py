@@ -1,9 +1,15 @@
 import os
+import logging
 import cv2
 import numpy as np
 import torch
 from PIL import Image
 import folder_paths
+from . import memory_budget
+from . import metrics
+from .profiling import profiled
+
+logger = logging.getLogger(__name__)
 
 class WanVideoVaceSeamlessJoin:
     """
@@ -53,6 +59,7 @@ class WanVideoVaceSeamlessJoin:
                     "display": "text",
                     "tooltip": "Full path to second video file - can be connected from other nodes"
                 }),
+                **memory_budget.budget_inputs(),
             }
         }
     
@@ -72,12 +79,13 @@ class WanVideoVaceSeamlessJoin:
         # Let the main processing function handle the validation
         return True
     
-    def load_video_frames(self, video_path, max_frames=None):
-        """Load video frames as numpy arrays"""
+    def load_video_frames(self, video_path, max_frames=None, size=None):
+        """Load video frames as numpy arrays, optionally resized to size (width, height)"""
         if not os.path.exists(video_path):
             raise ValueError(f"Video file not found: {video_path}")
             
-        cap = cv2.VideoCapture(video_path)
+        with metrics.stage(logger, "open", path=video_path):
+            cap = cv2.VideoCapture(video_path)
         
         # Check if video opened successfully
         if not cap.isOpened():
@@ -87,30 +95,35 @@ class WanVideoVaceSeamlessJoin:
         # Get video properties
         total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
         fps = cap.get(cv2.CAP_PROP_FPS)
-        print(f"[WanVideo] Video {video_path}: {total_frames} frames, {fps} fps")
+        logger.debug("Video %s: %d frames, %s fps", video_path, total_frames, fps)
         
         frames = []
         frame_count = 0
         
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
+        with metrics.stage(logger, "decode", path=video_path) as record:
+            while True:
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                    
+                # Convert BGR to RGB
+                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                if size is not None and (frame_rgb.shape[1], frame_rgb.shape[0]) != size:
+                    frame_rgb = cv2.resize(frame_rgb, size, interpolation=cv2.INTER_AREA)
+                frames.append(frame_rgb)
+                frame_count += 1
                 
-            # Convert BGR to RGB
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frames.append(frame_rgb)
-            frame_count += 1
-            
-            if max_frames and frame_count >= max_frames:
-                break
+                if max_frames and frame_count >= max_frames:
+                    break
+            record["frames"] = frame_count
+            record["bytes"] = metrics.tensor_bytes(*frames)
                 
         cap.release()
         
         if not frames:
             raise ValueError(f"No frames could be loaded from video: {video_path}")
             
-        print(f"[WanVideo] Successfully loaded {len(frames)} frames from {video_path}")
+        logger.debug("Loaded %d frames from %s", len(frames), video_path)
         return frames
     
     def create_solid_color_image(self, reference_frame, color_hex):
@@ -131,26 +144,55 @@ class WanVideoVaceSeamlessJoin:
             raise ValueError("Empty frames list provided")
             
         # Convert frames to tensor format (N, H, W, C) normalized to [0, 1]
-        tensor_frames = []
-        for frame in frames_list:
-            # Normalize to [0, 1]
-            normalized_frame = frame.astype(np.float32) / 255.0
-            tensor_frames.append(normalized_frame)
+        with metrics.stage(logger, "convert", frames=len(frames_list)) as record:
+            tensor_frames = []
+            for frame in frames_list:
+                # Normalize to [0, 1]
+                normalized_frame = frame.astype(np.float32) / 255.0
+                tensor_frames.append(normalized_frame)
+            record["bytes"] = metrics.tensor_bytes(*tensor_frames)
         
         # Stack into tensor
-        tensor_output = torch.from_numpy(np.stack(tensor_frames, axis=0))
+        with metrics.stage(logger, "stack", frames=len(tensor_frames)) as record:
+            tensor_output = torch.from_numpy(np.stack(tensor_frames, axis=0))
+            record["bytes"] = metrics.tensor_bytes(tensor_output)
         return tensor_output
     
+    def estimate_join_bytes(self, mask_last_frames, mask_first_frames, frame_load_cap,
+                            first_video_path, second_video_path):
+        """
+        Estimate peak bytes from container metadata: loaded uint8 frames, the uint8 filler and
+        mask frames, and both float32 outputs, which frames_to_tensor holds twice while stacking.
+        Returns (bytes, first video size).
+        """
+        first_count, width, height = memory_budget.probe_video(first_video_path)
+        second_count, second_width, second_height = memory_budget.probe_video(second_video_path)
+        first_count = min(first_count, frame_load_cap * 2)
+        second_count = min(second_count, frame_load_cap * 2)
+        
+        loaded_bytes = (first_count * memory_budget.frame_bytes(width, height, itemsize=1)
+                        + second_count * memory_budget.frame_bytes(second_width, second_height, itemsize=1))
+        
+        total_mask_count = mask_last_frames + mask_first_frames
+        first_section = max(0, min(frame_load_cap - mask_last_frames, first_count) - min(frame_load_cap // 2, first_count))
+        second_section = max(0, min(frame_load_cap // 2, second_count) - min(mask_first_frames, second_count))
+        output_frames = first_section + total_mask_count + second_section
+        mask_frames = max(0, frame_load_cap - mask_last_frames - frame_load_cap // 2) + total_mask_count \
+            + max(0, frame_load_cap // 2 - mask_first_frames)
+        
+        # Filler and mask frames are uint8 copies before conversion
+        copies_bytes = (total_mask_count + mask_frames) * memory_budget.frame_bytes(width, height, itemsize=1)
+        output_bytes = (output_frames + mask_frames) * memory_budget.frame_bytes(width, height)
+        return loaded_bytes + copies_bytes + 2 * output_bytes, (width, height)
+    
+    @profiled("process_videos")
     def process_videos(self, mask_last_frames, mask_first_frames, frame_load_cap, 
-                      first_video_path=None, second_video_path=None):
+                      first_video_path=None, second_video_path=None, memory_budget_mb=0, on_budget_exceeded="error"):
         """Main processing function that joins the video clips"""
         
-        print(f"[WanVideo] Starting process with parameters:")
-        print(f"  mask_last_frames: {mask_last_frames}")
-        print(f"  mask_first_frames: {mask_first_frames}")
-        print(f"  frame_load_cap: {frame_load_cap}")
-        print(f"  first_video_path: {first_video_path}")
-        print(f"  second_video_path: {second_video_path}")
+        logger.debug("Starting process: mask_last_frames=%s mask_first_frames=%s frame_load_cap=%s "
+                     "first_video_path=%s second_video_path=%s",
+                     mask_last_frames, mask_first_frames, frame_load_cap, first_video_path, second_video_path)
         
         # Handle None values (when inputs are not connected)
         if first_video_path is None:
@@ -171,16 +213,26 @@ class WanVideoVaceSeamlessJoin:
         if not os.path.exists(second_video_path):
             raise ValueError(f"Second video file not found: {second_video_path}")
         
-        print(f"[WanVideo] Both video files found, loading frames...")
+        # Check the estimated output size against the budget before decoding anything
+        size = None
+        budget_bytes = memory_budget.resolve_budget_bytes(memory_budget_mb)
+        if budget_bytes is not None:
+            estimated_bytes, first_size = self.estimate_join_bytes(mask_last_frames, mask_first_frames, frame_load_cap,
+                                                                   first_video_path, second_video_path)
+            scale = memory_budget.fit_to_budget(estimated_bytes, budget_bytes, on_budget_exceeded,
+                                                "WanVideoVaceSeamlessJoin")
+            if scale < 1.0:
+                # Both clips are resized to the same size so the frames can still be stacked
+                size = memory_budget.scaled_size(first_size[0], first_size[1], scale)
         
         # Load video frames
         try:
-            first_images_list = self.load_video_frames(first_video_path, frame_load_cap * 2)
-            second_images_list = self.load_video_frames(second_video_path, frame_load_cap * 2)
-            print(f"[WanVideo] Loaded {len(first_images_list)} frames from first video")
-            print(f"[WanVideo] Loaded {len(second_images_list)} frames from second video")
+            first_images_list = self.load_video_frames(first_video_path, frame_load_cap * 2, size)
+            second_images_list = self.load_video_frames(second_video_path, frame_load_cap * 2, size)
+            logger.debug("Loaded %d frames from first video and %d from second video",
+                         len(first_images_list), len(second_images_list))
         except Exception as e:
-            print(f"[WanVideo] Error loading video frames: {str(e)}")
+            logger.error("Error loading video frames: %s", e)
             raise ValueError(f"Error loading video frames: {str(e)}")
         
         if not first_images_list or not second_images_list:
@@ -262,9 +314,6 @@ class WanVideoVaceSeamlessJoin:
         if not output_mask_list:
             raise ValueError("No output masks generated")
         
-        print(f"[WanVideo] Generated {len(output_images_list)} output images")
-        print(f"[WanVideo] Generated {len(output_mask_list)} output masks")
-        
         try:
             image_tensor = self.frames_to_tensor(output_images_list)
             mask_tensor = self.frames_to_tensor(output_mask_list)
@@ -272,14 +321,13 @@ class WanVideoVaceSeamlessJoin:
             # Keep mask as RGB IMAGE type instead of converting to grayscale
             # This ensures compatibility with nodes expecting IMAGE input
             
-            print(f"[WanVideo] Image tensor shape: {image_tensor.shape}")
-            print(f"[WanVideo] Mask tensor shape: {mask_tensor.shape}")
-            print(f"[WanVideo] Processing completed successfully")
+            logger.info("Joined clips into image tensor %s and mask tensor %s",
+                        tuple(image_tensor.shape), tuple(mask_tensor.shape))
             
             return (image_tensor, mask_tensor)
             
         except Exception as e:
-            print(f"[WanVideo] Error creating tensors: {str(e)}")
+            logger.error("Error creating tensors: %s", e)
             raise ValueError(f"Error creating output tensors: {str(e)}")
 
 # ComfyUI Node Registration